@@ -1,50 +1,132 @@
+"""
+Box plots comparing the ANIMA metrics of several methods (one PNG per metric).
+
+Usage example:
+    python boxplot_comparison.py --xml-folders <anima_stats_2d> <anima_stats_3d> --method-labels 2d 3d
+                                 --output-folder <output_folder> --jobs 4 --summary
+
+The methods can also be given with a JSON config file (--config):
+    {
+        "methods": [{"label": "2d", "xml_folder": "<anima_stats_2d>"}, {"label": "3d", "xml_folder": "<anima_stats_3d>"}],
+        "output_folder": "<output_folder>"
+    }
+
+Without arguments, the folders and method names are asked interactively.
+"""
+
 import os
-import xml.etree.ElementTree as ET
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+matplotlib.use('Agg')  # non-interactive backend, to render in batch jobs and worker processes
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
+from metrics_table import build_metrics_table_from_folder
+
+# List of metrics calculated by Anima
+METRICS = ['Jaccard', 'Dice', 'Sensitivity', 'Specificity', 'PPV', 'NPV',
+           'RelativeVolumeError', 'HausdorffDistance', 'ContourMeanDistance', 'SurfaceDistance']
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Plot box plots comparing the ANIMA metrics of several methods.')
+    parser.add_argument('--xml-folders', type=str, nargs='+',
+                        help='Folders containing the XML files (or metrics_table.parquet) of each method')
+    parser.add_argument('--method-labels', type=str, nargs='+',
+                        help='Name of each method, in the same order as --xml-folders')
+    parser.add_argument('--config', type=str,
+                        help='JSON file listing the methods and the output folder, instead of --xml-folders, '
+                             '--method-labels and --output-folder')
+    parser.add_argument('--output-folder', type=str,
+                        help='Folder where the box plots are saved')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='Number of processes used to render the box plots. Default: 1')
+    parser.add_argument('--summary', action='store_true',
+                        help='Also render all the metrics in a single multi-panel figure '
+                             '(all_metrics_comparison_boxplot.png)')
+    return parser
 
-def plot_box_plots(xml_folders,method_labels, output_folder):
-    # List of metrics calculated by Anima
-    metrics = ['Jaccard', 'Dice', 'Sensitivity', 'Specificity', 'PPV', 'NPV', 
-               'RelativeVolumeError', 'HausdorffDistance', 'ContourMeanDistance', 'SurfaceDistance']
+
+def get_metric_values(xml_folders, method_labels, metrics=METRICS):
+    """
+    :return: dict {metric: list of the values of each method}
+    """
+    # Read the metrics of all the methods in a single table (see metrics_table.py)
+    table = pd.concat([build_metrics_table_from_folder(xml_folder, method_label)
+                       for xml_folder, method_label in zip(xml_folders, method_labels)], ignore_index=True)
+    values_by_metric_method = table.groupby(['metric', 'method'], observed=True)['value']
 
     metric_values = {metric: [] for metric in metrics}
+    for metric in metrics:
+        for method_label in method_labels:
+            if (metric, method_label) in values_by_metric_method.groups:
+                metric_values[metric].append(values_by_metric_method.get_group((metric, method_label)).tolist())
+            else:
+                metric_values[metric].append([])
+    return metric_values
+
+
+def draw_box_plot(ax, values, method_labels, metric, fontsize_scale=1.0):
+    ax.boxplot(values, patch_artist=True, labels=method_labels, widths=0.5)
+    ax.set_title(f"Comparaison des méthodes pour {metric}", fontsize=20 * fontsize_scale)
+    ax.set_ylabel("Valeur", fontsize=25 * fontsize_scale)
+    ax.set_xlabel("Méthodes testées", fontsize=25 * fontsize_scale)
+    ax.grid(True)
+    plt.setp(ax.get_xticklabels(), rotation=20, ha='right', fontsize=18 * fontsize_scale)
+
+
+def render_box_plots(metric_values, method_labels, output_folder):
+    """
+    Saves one PNG per metric. A single figure is created and cleared between the metrics.
+
+    :param metric_values: list of (metric, list of the values of each method)
+    """
+    fig = plt.figure(figsize=(12, 12))
+    for metric, values in metric_values:
+        fig.clear()
+        draw_box_plot(fig.add_subplot(), values, method_labels, metric)
+        fig.subplots_adjust(bottom=0.2)
+        fig.savefig(os.path.join(output_folder, f"{metric}_comparison_boxplot.png"))
+    plt.close(fig)
 
-    for xml_folder in xml_folders:
-        method_data = {metric: [] for metric in metrics}
-        index = xml_folders.index(xml_folder)
-        method_label = method_labels[index]
-
-        for filename in os.listdir(xml_folder):
-            if filename.endswith(".xml"):
-                xml_path = os.path.join(xml_folder, filename)
-                tree = ET.parse(xml_path)
-                root = tree.getroot()
-
-                for metric in metrics:
-                    metric_node = root.find(f"./measure[@name='{metric}']")
-                    if metric_node is not None:
-                        metric_value = float(metric_node.text)
-                        method_data[metric].append(metric_value)
-        
-        for metric in metrics:
-            metric_values[metric].append(method_data[metric])
+
+def render_summary_figure(metric_values, method_labels, output_folder, ncols=5):
+    """
+    Saves all the metrics in a single multi-panel figure.
+    """
+    nrows = int(np.ceil(len(metric_values) / ncols))
+    fig, axes = plt.subplots(nrows, ncols, figsize=(6 * ncols, 6 * nrows), squeeze=False)
+    for ax, (metric, values) in zip(axes.flat, metric_values):
+        draw_box_plot(ax, values, method_labels, metric, fontsize_scale=0.5)
+    for ax in axes.flat[len(metric_values):]:
+        ax.set_visible(False)
+    fig.tight_layout()
+    fig.savefig(os.path.join(output_folder, "all_metrics_comparison_boxplot.png"))
+    plt.close(fig)
+
+
+def plot_box_plots(xml_folders, method_labels, output_folder, jobs=1, summary=False):
+    metric_values = list(get_metric_values(xml_folders, method_labels).items())
 
     #Plotting the Boxplots
-    for metric in metrics:
-        plt.figure(figsize=(12, 12))
-        plt.boxplot(metric_values[metric], patch_artist=True, labels=method_labels, widths = 0.5)
-        plt.title(f"Comparaison des méthodes pour {metric}", fontsize=20) 
-        plt.ylabel("Valeur",fontsize=25)
-        plt.xlabel("Méthodes testées", fontsize=25)
-        plt.grid(True)
-        plt.xticks(rotation=20,ha='right',fontsize=18)
-        plt.subplots_adjust(wspace=0.5)  
-        plt.subplots_adjust(bottom=0.2)
-        plt.savefig(os.path.join(output_folder, f"{metric}_comparison_boxplot.png"))  
-        plt.close()
+    if jobs > 1:
+        # each worker renders a chunk of the metrics with its own figure
+        chunks = [metric_values[i::jobs] for i in range(jobs) if metric_values[i::jobs]]
+        with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+            futures = [executor.submit(render_box_plots, chunk, method_labels, output_folder) for chunk in chunks]
+            if summary:
+                render_summary_figure(metric_values, method_labels, output_folder)
+            for future in futures:
+                future.result()
+    else:
+        render_box_plots(metric_values, method_labels, output_folder)
+        if summary:
+            render_summary_figure(metric_values, method_labels, output_folder)
 
-if __name__ == "__main__":
+
+def ask_methods():
     xml_folders = []
     method_labels = []
     n = int(input("Combien de méthodes à comparer ? "))
@@ -56,8 +138,40 @@ if __name__ == "__main__":
         method_labels.append(label)
 
     output_folder = input("chemin vers le dossier de sortie pour les graphiques: ")
+    return xml_folders, method_labels, output_folder
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    if args.config is not None:
+        with open(args.config) as f:
+            config = json.load(f)
+        methods = config.get('methods')
+        if not methods or any('xml_folder' not in method or 'label' not in method for method in methods):
+            parser.error(f'{args.config} should list the methods in "methods", each with a "label" and an "xml_folder"')
+        xml_folders = [method['xml_folder'] for method in methods]
+        method_labels = [method['label'] for method in methods]
+        output_folder = args.output_folder or config.get('output_folder')
+        if output_folder is None:
+            parser.error(f'{args.config} has no "output_folder", give it with --output-folder')
+    elif args.xml_folders is not None:
+        xml_folders = args.xml_folders
+        method_labels = args.method_labels or [os.path.basename(os.path.normpath(f)) for f in xml_folders]
+        output_folder = args.output_folder
+        if len(method_labels) != len(xml_folders):
+            parser.error('--method-labels should have as many values as --xml-folders')
+        if output_folder is None:
+            parser.error('--output-folder is required with --xml-folders')
+    else:
+        xml_folders, method_labels, output_folder = ask_methods()
+
     os.makedirs(output_folder, exist_ok=True)
 
-    plot_box_plots(xml_folders, method_labels, output_folder)
-    print("Les diagrammes en boîte ont été enregistrés avec succès.")   
- 
+    plot_box_plots(xml_folders, method_labels, output_folder, jobs=args.jobs, summary=args.summary)
+    print("Les diagrammes en boîte ont été enregistrés avec succès.")
+
+
+if __name__ == "__main__":
+    main()
@@ -66,10 +66,20 @@ echo "anima = ${HOME}/anima/Anima-Binaries-4.2/" >> .anima/config.txt
 echo "anima-scripts-public-root = ${HOME}/anima/Anima-Scripts-Public/" >> .anima/config.txt
 echo "extra-data-root = ${HOME}/anima/Anima-Scripts-Data-Public/" >> .anima/config.txt
 
+##### STEP 3: Install the Python dependencies #####
+# pyarrow is required to save and read the metrics table (anima_stats/metrics_table.parquet)
+pip install numpy scipy pandas nibabel pyarrow
+
 USAGE:
 python compute_anima_metrics.py --pred_folder <path_to_predictions_folder> 
 --gt_folder <path_to_gt_folder> -dname <dataset_name> --label-type <sc/lesion>
 
+The metrics can also be computed in-process with `--engine native` (see seg_metrics.py), which does not
+require ANIMA to be installed and avoids spawning one process per subject and label. `--engine both` runs
+ANIMA and the native engine and reports the metrics which differ by more than `--tolerance`.
+The native engine does not compute the lesion detection metrics (-l: PPVL, SensL, F1_score), since it does not
+implement ANIMA's detection rules: use `--engine anima` (or both) to get them.
+
 
 NOTE 1: For checking all the available options run the following command from your terminal: 
       <anima_binaries_path>/animaSegPerfAnalyzer -h
@@ -84,17 +94,28 @@ Authors: Naga Karthik, Jan Valosek
 
 import os
 import glob
+import json
+import hashlib
 import subprocess
 import argparse
-from collections import defaultdict
-import xml.etree.ElementTree as ET
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+import pandas as pd
 import nibabel as nib
 from test_utils import fetch_filename_details
+from seg_metrics import DETECTION_METRICS, compute_metrics, write_anima_xml, read_anima_xml, read_anima_xml_name, \
+    compare_metrics
+from metrics_table import TABLE_FILENAME, build_metrics_table, save_metrics_table, get_valid_metrics
 
 
 REGION_BASED_DATASETS = ["sci-zurich-region", "sci-colorado-region","MyDataset"]
 STANDARD_DATASETS = ["spine-generic", "sci-colorado", "sci-zurich", "basel-mp2rage"]
+CACHE_FILENAME = 'metrics_cache.json'
+# suffix of the XML file written by `animaSegPerfAnalyzer -X` (and by the native engine) for an output prefix
+XML_SUFFIX = '_global.xml'
+# version of the layout of the cache, caches with another version are ignored
+CACHE_VERSION = 2
 
 
 def get_parser():
@@ -114,17 +135,318 @@ def get_parser():
                             'Options: "SC" for spinal cord segmentation, "GM" for grey matter segmentation'
                             'NOTE: when label-type is "lesion", additional lesion detection metrics, namely,'
                             'Lesion PPV, Lesion Sensitivity, and F1_score are computed')
+    parser.add_argument('--engine', default='anima', type=str, choices=['anima', 'native', 'both'],
+                        help='Engine used to compute the metrics. "anima": animaSegPerfAnalyzer, "native": in-process '
+                             'NumPy/SciPy implementation (seg_metrics.py), "both": run both and report the metrics '
+                             'that differ by more than --tolerance. The native engine does not compute the lesion '
+                             'detection metrics (PPVL, SensL, F1_score). Default: anima')
+    parser.add_argument('--tolerance', default=1e-3, type=float,
+                        help='Absolute and relative tolerance used to compare the native metrics with ANIMA when '
+                             '"--engine both" is used. Default: 1e-3')
+    parser.add_argument('--jobs', '-j', default=1, type=int,
+                        help='Number of processes used to evaluate the (subject, label) pairs in parallel. '
+                             'Default: 1')
+    parser.add_argument('--tmp-dir', default=None, type=str,
+                        help='Folder where the private scratch directory of the run is created to store the '
+                             'binarized masks given to ANIMA. Default: /dev/shm if available, otherwise the system '
+                             'temporary folder')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Evaluate all the subjects again instead of reusing the metrics cached in the '
+                             '"anima_stats" folder for the unchanged (prediction, GT, label, flags) tuples')
   #  parser.add_argument('-o', '--output-folder', required=True, type=str,
 #                        help='Path to the output folder to save the test metrics results')
 
     return parser
 
-def get_test_metrics_by_dataset(pred_folder, gt_folder, output_folder, anima_binaries_path, data_set, label_type):
+def get_scratch_root():
+    """
+    Returns the folder where the scratch directory of a run is created: /dev/shm (tmpfs, i.e. in memory) when
+    available, otherwise the system temporary folder.
+    """
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def run_seg_perf_analyzer(anima_binaries_path, pred_path, gt_path, out_prefix, flags):
+    """
+    Runs the "animaSegPerfAnalyzer" command on a binarized prediction/GT pair saved on disk.
+    The metrics are saved by ANIMA in XML files named after `out_prefix`.
+    """
+    seg_perf_analyzer_cmd = [os.path.join(anima_binaries_path, 'animaSegPerfAnalyzer'),
+                             '-i', pred_path, '-r', gt_path, '-o', out_prefix, *flags, '-X']
+    subprocess.run(seg_perf_analyzer_cmd, check=True)
+
+
+def list_xml_files(out_prefix):
+    """
+    Returns the XML files saved for the output prefix `out_prefix`, i.e. `{out_prefix}_global.xml` if it exists.
+    The exact name is used (and not a `{out_prefix}*` glob) so that the files of the other subjects/labels sharing
+    the same prefix (e.g. `001_SC_global.xml` for `001`) are not counted.
+    """
+    return [xml_path for xml_path in [f"{out_prefix}{XML_SUFFIX}"] if os.path.isfile(xml_path)]
+
+
+def evaluate_pair(pred_npy, gt_npy, pred_path, gt_path, out_prefix, flags, engine, anima_binaries_path, tolerance):
+    """
+    Computes the metrics of a binarized prediction/GT pair with ANIMA and/or the native engine.
+
+    With ANIMA, the binarized arrays are saved to `pred_path` and `gt_path` (uncompressed uint8 NIfTI files in
+    the scratch directory of the run), evaluated and then deleted.
+    With the native engine, the metrics are computed in-process and saved in `{out_prefix}_global.xml`
+    using the same layout as ANIMA. The voxel size is set to 1 for the surface distances, as the NIfTI files
+    given to ANIMA are saved with an identity affine. The lesion detection metrics (flag -l) are not computed
+    natively since seg_metrics.py does not implement ANIMA's detection rules, and they are not compared with
+    "--engine both".
+    """
+    if engine in ['anima', 'both']:
+        # Save the binarized predictions and GTs (bool is not supported by NIfTI, hence uint8)
+        pred_nib = nib.Nifti1Image(pred_npy.astype(np.uint8), affine=np.eye(4))
+        gtc_nib = nib.Nifti1Image(gt_npy.astype(np.uint8), affine=np.eye(4))
+        nib.save(img=pred_nib, filename=pred_path)
+        nib.save(img=gtc_nib, filename=gt_path)
+
+        # Run ANIMA segmentation performance metrics on the predictions
+        try:
+            run_seg_perf_analyzer(anima_binaries_path, pred_path, gt_path, out_prefix, flags)
+        finally:
+            # Delete temporary binarized NIfTI files
+            os.remove(pred_path)
+            os.remove(gt_path)
+
+    if engine in ['native', 'both']:
+        metrics = compute_metrics(pred_npy, gt_npy, segmentation='-s' in flags, distance='-d' in flags)
+        if engine == 'native':
+            write_anima_xml(metrics, f"{out_prefix}{XML_SUFFIX}", name=os.path.basename(pred_path))
+        else:
+            for xml_path in list_xml_files(out_prefix):
+                reference = {name: value for name, value in read_anima_xml(xml_path).items()
+                             if name not in DETECTION_METRICS}
+                mismatches = compare_metrics(metrics, reference, tolerance=tolerance)
+                for name, (value, ref_value) in mismatches.items():
+                    print(f"Mismatch for {name} in {xml_path}: native={value:.6f}, ANIMA={ref_value:.6f}")
+
+
+def load_label_map(path):
+    """
+    Loads a NIfTI image in its on-disk datatype (e.g. uint8 for nnUNet predictions and labels) instead of
+    promoting it to float64 as `get_fdata` does.
+    """
+    return np.asanyarray(nib.load(path).dataobj)
+
+
+def binarize(label_map, label_values):
+    """
+    Builds the binary masks of all the labels in a single vectorized pass.
+
+    :param label_map: label map as returned by `load_label_map`
+    :param label_values: list of label values, or [None] to binarize a soft/binary segmentation with a 0.5 threshold
+    :return: boolean array of shape (len(label_values), *label_map.shape)
+    """
+    if label_values == [None]:
+        return (label_map > 0.5)[np.newaxis]
+    label_values = np.asarray(label_values).reshape((-1,) + (1,) * label_map.ndim)
+    return label_map == label_values
+
+
+def evaluate_task(task):
+    """
+    Evaluates one subject task built by `get_test_metrics_by_dataset`, i.e. one prediction/GT pair and all the
+    labels to evaluate on it. Each file is loaded only once whatever the number of labels. This function is run
+    in the worker processes when `--jobs` > 1, hence all exceptions are caught and returned instead of raised.
+
+    :return: list of (list of XML filepaths, error message or None), one per (subject, label) evaluation
+    """
+    evaluations = task['evaluations']
+    try:
+        # load the predictions and GTs and binarize all the labels at once
+        # (ANIMA accepts binarized inputs only)
+        label_values = [evaluation['label_value'] for evaluation in evaluations]
+        pred_masks = binarize(load_label_map(task['pred_file']), label_values)
+        gt_masks = binarize(load_label_map(task['gt_file']), label_values)
+    except Exception as e:
+        return [([], f"{type(e).__name__}: {e}")] * len(evaluations)
+
+    results = []
+    for evaluation, pred_npy, gt_npy in zip(evaluations, pred_masks, gt_masks):
+        try:
+            evaluate_pair(pred_npy, gt_npy, evaluation['pred_path'], evaluation['gt_path'], evaluation['out_prefix'],
+                          evaluation['flags'], task['engine'], task['anima_binaries_path'], task['tolerance'])
+            results.append((list_xml_files(evaluation['out_prefix']), None))
+        except Exception as e:
+            results.append(([], f"{type(e).__name__}: {e}"))
+    return results
+
+
+def run_tasks(tasks, jobs=1):
+    """
+    Runs the evaluation tasks, in a pool of `jobs` processes if `jobs` > 1. The results are returned in the same
+    order as the tasks, whatever the order in which they complete. Failed evaluations are reported at the end.
+
+    :return: list of (evaluation, list of XML filepaths, error message or None), one per (subject, label) evaluation
+    """
+    if jobs > 1:
+        task_results = []
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(evaluate_task, task) for task in tasks]
+            for task, future in zip(tasks, futures):
+                try:
+                    task_results.append(future.result())
+                except Exception as e:   # e.g. worker killed by the OS
+                    task_results.append([([], f"{type(e).__name__}: {e}")] * len(task['evaluations']))
+    else:
+        task_results = [evaluate_task(task) for task in tasks]
+
+    results = [(evaluation, xml_files, error)
+               for task, evaluation_results in zip(tasks, task_results)
+               for evaluation, (xml_files, error) in zip(task['evaluations'], evaluation_results)]
+
+    failures = [(evaluation, error) for evaluation, _, error in results if error is not None]
+    if failures:
+        print(f"{len(failures)}/{len(results)} evaluation(s) failed:")
+        for evaluation, error in failures:
+            print(f"\t{evaluation['name']} -> {error}")
+    return results
+
+
+def hash_file(path, file_hashes):
+    """
+    Returns the SHA-256 of the content of a file. The hashes are memoized in `file_hashes` with the size and
+    modification time of the file, so that unchanged files are not read again.
+    """
+    stat = os.stat(path)
+    entry = file_hashes.get(os.path.abspath(path))
+    if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return entry[2]
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    file_hashes[os.path.abspath(path)] = [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+    return sha.hexdigest()
+
+
+def get_cache_key(pred_hash, gt_hash, evaluation, engine):
+    """
+    Returns the cache key of an evaluation: a hash of the (prediction, GT, label, analyzer flags) tuple, along
+    with the engine and the output name since they change the saved XML files.
+    """
+    content = [pred_hash, gt_hash, evaluation['label'], evaluation['label_value'], evaluation['flags'], engine,
+               os.path.basename(evaluation['out_prefix'])]
+    return hashlib.sha256(json.dumps(content).encode('utf-8')).hexdigest()
+
+
+def load_cache(output_folder):
+    """
+    Loads the evaluation cache of `output_folder`, or returns an empty cache if it does not exist, is corrupted or
+    was written with another layout (`CACHE_VERSION`).
+    """
+    cache_path = os.path.join(output_folder, CACHE_FILENAME)
+    if os.path.isfile(cache_path):
+        try:
+            with open(cache_path) as f:
+                cache = json.load(f)
+            if cache.get('version') == CACHE_VERSION:
+                return cache
+            print(f"Ignoring cache {cache_path} written by another version of this script")
+        except (ValueError, OSError) as e:
+            print(f"Ignoring unreadable cache {cache_path}: {e}")
+    return {'version': CACHE_VERSION, 'file_hashes': {}, 'evaluations': {}}
+
+
+def save_cache(cache, output_folder):
+    cache_path = os.path.join(output_folder, CACHE_FILENAME)
+    # write to a temporary file first so that an interrupted run does not leave a truncated cache
+    with open(cache_path + '.tmp', 'w') as f:
+        json.dump(cache, f)
+    os.replace(cache_path + '.tmp', cache_path)
+
+
+def run_cached_tasks(tasks, jobs, output_folder, use_cache=True):
+    """
+    Same as `run_tasks`, but only the evaluations which are not in the cache of `output_folder` are run.
+    The cache stores the per-subject metrics of each evaluation (with the image name of their XML files), keyed by
+    `get_cache_key`, and the XML files of the cached evaluations are written again from it. The evaluations and file
+    hashes which are not used by this run are removed from the cache.
+
+    :return: list of (evaluation, list of XML filepaths, error message or None), one per (subject, label) evaluation
+    """
+    if not use_cache:
+        return run_tasks(tasks, jobs)
+
+    cache = load_cache(output_folder)
+
+    # keep only the evaluations whose inputs changed since the last run
+    pending_tasks = []
+    for task in tasks:
+        pred_hash = hash_file(task['pred_file'], cache['file_hashes'])
+        gt_hash = hash_file(task['gt_file'], cache['file_hashes'])
+        pending_evaluations = []
+        for evaluation in task['evaluations']:
+            evaluation['cache_key'] = get_cache_key(pred_hash, gt_hash, evaluation, task['engine'])
+            if evaluation['cache_key'] not in cache['evaluations']:
+                pending_evaluations.append(evaluation)
+        if pending_evaluations:
+            pending_tasks.append(dict(task, evaluations=pending_evaluations))
+
+    nb_evaluations = sum(len(task['evaluations']) for task in tasks)
+    nb_pending = sum(len(task['evaluations']) for task in pending_tasks)
+    print(f"{nb_evaluations - nb_pending}/{nb_evaluations} evaluation(s) found in the cache")
+
+    new_results = {}
+    for evaluation, xml_files, error in run_tasks(pending_tasks, jobs):
+        new_results[evaluation['cache_key']] = (xml_files, error)
+        if error is None and xml_files:
+            cache['evaluations'][evaluation['cache_key']] = {
+                os.path.basename(f): {'name': read_anima_xml_name(f), 'metrics': read_anima_xml(f)} for f in xml_files}
+
+    # prune the entries of the predictions, GTs and evaluations which are not part of this run anymore
+    used_keys = {evaluation['cache_key'] for task in tasks for evaluation in task['evaluations']}
+    used_files = {os.path.abspath(task[key]) for task in tasks for key in ['pred_file', 'gt_file']}
+    cache['evaluations'] = {key: value for key, value in cache['evaluations'].items() if key in used_keys}
+    cache['file_hashes'] = {path: value for path, value in cache['file_hashes'].items() if path in used_files}
+    save_cache(cache, output_folder)
+
+    # gather the results in the order of the tasks
+    results = []
+    for task in tasks:
+        for evaluation in task['evaluations']:
+            if evaluation['cache_key'] in new_results:
+                xml_files, error = new_results[evaluation['cache_key']]
+            else:
+                xml_files, error = [], None
+                for xml_name, xml_content in cache['evaluations'][evaluation['cache_key']].items():
+                    # always written again, the file may have been overwritten by a run with another engine
+                    xml_path = os.path.join(output_folder, xml_name)
+                    write_anima_xml(xml_content['metrics'], xml_path, name=xml_content['name'])
+                    xml_files.append(xml_path)
+            results.append((evaluation, xml_files, error))
+    return results
+
+
+def get_test_metrics_by_dataset(pred_folder, gt_folder, output_folder, anima_binaries_path, data_set, label_type,
+                                engine='anima', tolerance=1e-3, jobs=1, tmp_dir=None, use_cache=True):
     """
     Computes the test metrics given folders containing nifti images of test predictions 
-    and GT images by running the "animaSegPerfAnalyzer" command
+    and GT images by running the "animaSegPerfAnalyzer" command (or its native equivalent, see `evaluate_pair`)
+
+    One task is created per subject, holding one evaluation per label, and the tasks are run in parallel when
+    `jobs` > 1. The binarized masks given to ANIMA are written in a private scratch directory created in `tmp_dir`
+    (see `get_scratch_root`) and removed at the end of the run, even on failure. Nothing is written to the
+    prediction and GT folders.
+    Unless `use_cache` is False, only the new or changed (prediction, GT, label) tuples are evaluated, see
+    `run_cached_tasks`.
     """
     print(data_set) 
+    with tempfile.TemporaryDirectory(prefix='anima_metrics_', dir=tmp_dir or get_scratch_root()) as scratch_dir:
+        return _get_test_metrics_by_dataset(pred_folder, gt_folder, output_folder, anima_binaries_path, data_set,
+                                            label_type, engine, tolerance, jobs, scratch_dir, use_cache)
+
+
+def _get_test_metrics_by_dataset(pred_folder, gt_folder, output_folder, anima_binaries_path, data_set, label_type,
+                                 engine, tolerance, jobs, scratch_dir, use_cache):
+    tasks = []
     if data_set in REGION_BASED_DATASETS:
         # glob all the predictions and GTs and get the last three digits of the filename
         pred_files = sorted(glob.glob(os.path.join(pred_folder, "*.nii.gz")))
@@ -132,7 +454,7 @@ def get_test_metrics_by_dataset(pred_folder, gt_folder, output_folder, anima_bin
 
         dataset_name_nnunet = fetch_filename_details(pred_files[0])[0]
 
-        # loop over the predictions and compute the metrics
+        # loop over the predictions and create the evaluation tasks
         for pred_file, gt_file in zip(pred_files, gt_files):
             
             _, sub_pred, ses_pred, idx_pred, _ = fetch_filename_details(pred_file)
@@ -148,46 +470,40 @@ def get_test_metrics_by_dataset(pred_folder, gt_folder, output_folder, anima_bin
                 sub_ses_pred, sub_ses_gt = f"{sub_pred}_{ses_pred}", f"{sub_gt}_{ses_gt}"
             assert sub_ses_pred == sub_ses_gt, 'Subject and session IDs for Preds and GTs do not match. Please check the filenames.'
 
-            for seg in ['SC', 'GM']:
-                # load the predictions and GTs
-                pred_npy = nib.load(pred_file).get_fdata()
-                gt_npy = nib.load(gt_file).get_fdata()
-
-                if seg == 'SC':
-                    pred_npy = np.array(pred_npy == 1, dtype=float)
-                    gt_npy = np.array(gt_npy == 1, dtype=float)                
-                
-                elif seg == 'GM':
-                    pred_npy = np.array(pred_npy == 2, dtype=float)
-                    gt_npy = np.array(gt_npy == 2, dtype=float)
-                
-                # Save the binarized predictions and GTs
-                pred_nib = nib.Nifti1Image(pred_npy, affine=np.eye(4))
-                gtc_nib = nib.Nifti1Image(gt_npy, affine=np.eye(4))
-                nib.save(img=pred_nib, filename=os.path.join(pred_folder, f"{dataset_name_nnunet}_{sub_ses_pred}_{idx_pred}_{seg}.nii.gz"))
-                nib.save(img=gtc_nib, filename=os.path.join(gt_folder, f"{dataset_name_nnunet}_{sub_ses_gt}_{idx_gt}_{seg}.nii.gz"))
-
-                # Run ANIMA segmentation performance metrics on the predictions
+            evaluations = []
+            for seg, label_value in [('SC', 1), ('GM', 2)]:
+                # Run segmentation performance metrics on the predictions
                 if seg == 'SC':
-                    seg_perf_analyzer_cmd = '%s -i %s -r %s -o %s -d -s -X'
+                    flags = ['-d', '-s']
                 elif seg == 'GM':   # add lesion evaluation metrics with `-l`
-                    seg_perf_analyzer_cmd = '%s -i %s -r %s -o %s -d -s -l -X'
-                
-                os.system(seg_perf_analyzer_cmd %
-                            (os.path.join(anima_binaries_path, 'animaSegPerfAnalyzer'),
-                            os.path.join(pred_folder, f"{dataset_name_nnunet}_{sub_ses_pred}_{idx_pred}_{seg}.nii.gz"),
-                            os.path.join(gt_folder, f"{dataset_name_nnunet}_{sub_ses_gt}_{idx_gt}_{seg}.nii.gz"),
-                            os.path.join(output_folder, f"{idx_pred}_{seg}")))
-
-                # Delete temporary binarized NIfTI files
-                os.remove(os.path.join(pred_folder, f"{dataset_name_nnunet}_{sub_ses_pred}_{idx_pred}_{seg}.nii.gz"))
-                os.remove(os.path.join(gt_folder, f"{dataset_name_nnunet}_{sub_ses_gt}_{idx_gt}_{seg}.nii.gz"))
+                    flags = ['-d', '-s', '-l']
+
+                evaluations.append({
+                    'name': f"{sub_ses_pred}_{idx_pred}_{seg}",
+                    'label': seg,
+                    'label_value': label_value,
+                    'pred_path': os.path.join(scratch_dir, f"{dataset_name_nnunet}_{sub_ses_pred}_{idx_pred}_{seg}_pred.nii"),
+                    'gt_path': os.path.join(scratch_dir, f"{dataset_name_nnunet}_{sub_ses_gt}_{idx_gt}_{seg}_gt.nii"),
+                    'out_prefix': os.path.join(output_folder, f"{idx_pred}_{seg}"),
+                    'flags': flags,
+                })
+
+            tasks.append({
+                'pred_file': pred_file,
+                'gt_file': gt_file,
+                'evaluations': evaluations,
+                'engine': engine,
+                'anima_binaries_path': anima_binaries_path,
+                'tolerance': tolerance,
+            })
+
+        results = run_cached_tasks(tasks, jobs, output_folder, use_cache)
 
         # Get all XML filepaths where ANIMA performance metrics are saved for each hold-out subject
-        subject_sc_filepaths = [os.path.join(output_folder, f) for f in
-                                os.listdir(output_folder) if f.endswith('.xml') and 'SC' in f]
-        subject_gm_filepaths = [os.path.join(output_folder, f) for f in
-                                os.listdir(output_folder) if f.endswith('.xml') and 'GM' in f]
+        subject_sc_filepaths = [f for evaluation, xml_files, _ in results if evaluation['label'] == 'SC'
+                                for f in xml_files]
+        subject_gm_filepaths = [f for evaluation, xml_files, _ in results if evaluation['label'] == 'GM'
+                                for f in xml_files]
         print(f"subject sc {subject_sc_filepaths}")
         print(f"subject gm {subject_gm_filepaths}")  
         return subject_sc_filepaths, subject_gm_filepaths
@@ -199,10 +515,18 @@ def get_test_metrics_by_dataset(pred_folder, gt_folder, output_folder, anima_bin
 
         dataset_name_nnunet = fetch_filename_details(pred_files[0])[0]
 
-        # loop over the predictions and compute the metrics
+        # loop over the predictions and create the evaluation tasks
         print("Predictions files:", pred_files)
         print("Ground truth files:", gt_files)
 
+        # Run segmentation performance metrics on the predictions
+        if label_type == 'lesion':
+            flags = ['-d', '-l', '-s']
+        elif label_type == 'GM':
+            flags = ['-d', '-s']
+        else:
+            raise ValueError('Please specify a valid label type: lesion or GM')
+
         for pred_file, gt_file in zip(pred_files, gt_files):
             print(" Prediction file:", pred_file)
             print("Ground truth file:", gt_file)
@@ -220,61 +544,68 @@ def get_test_metrics_by_dataset(pred_folder, gt_folder, output_folder, anima_bin
                 sub_ses_pred, sub_ses_gt = f"{sub_pred}_{ses_pred}", f"{sub_gt}_{ses_gt}"
             assert sub_ses_pred == sub_ses_gt, 'Subject and session IDs for Preds and GTs do not match. Please check the filenames.'
 
-            # load the predictions and GTs
-            pred_npy = nib.load(pred_file).get_fdata()
-            gt_npy = nib.load(gt_file).get_fdata()
-            
-            # make sure the predictions are binary because ANIMA accepts binarized inputs only
-            pred_npy = np.array(pred_npy > 0.5, dtype=float)
-            gt_npy = np.array(gt_npy > 0.5, dtype=float)
-
-            # Save the binarized predictions and GTs
-            pred_nib = nib.Nifti1Image(pred_npy, affine=np.eye(4))
-            gtc_nib = nib.Nifti1Image(gt_npy, affine=np.eye(4))
-            nib.save(img=pred_nib, filename=os.path.join(pred_folder, f"{dataset_name_nnunet}_{idx_pred}_bin.nii.gz"))
-            nib.save(img=gtc_nib, filename=os.path.join(gt_folder, f"{dataset_name_nnunet}_{idx_gt}_bin.nii.gz"))
-	    
-
-            # Run ANIMA segmentation performance metrics on the predictions            
-            if label_type == 'lesion':
-                 seg_perf_analyzer_cmd = '%s -i %s -r %s -o %s -d -l -s -X'
-            elif label_type == 'GM':
-                seg_perf_analyzer_cmd = '%s -i %s -r %s -o %s -d -s -X'
-            else:
-                raise ValueError('Please specify a valid label type: lesion or GM')
-
-            os.system(seg_perf_analyzer_cmd %
-                        (os.path.join(anima_binaries_path, 'animaSegPerfAnalyzer'),
-                        os.path.join(pred_folder, f"{dataset_name_nnunet}_{idx_pred}_bin.nii.gz"),
-                        os.path.join(gt_folder, f"{dataset_name_nnunet}_{idx_gt}_bin.nii.gz"),
-                        os.path.join(output_folder, f"{idx_pred}")))
-
-            # Delete temporary binarized NIfTI files
-            os.remove(os.path.join(pred_folder, f"{dataset_name_nnunet}_{idx_pred}_bin.nii.gz"))
-            os.remove(os.path.join(gt_folder, f"{dataset_name_nnunet}_{idx_gt}_bin.nii.gz"))
+            tasks.append({
+                'pred_file': pred_file,
+                'gt_file': gt_file,
+                'evaluations': [{
+                    'name': f"{sub_ses_pred}_{idx_pred}",
+                    'label': label_type,
+                    'label_value': None,
+                    'pred_path': os.path.join(scratch_dir, f"{dataset_name_nnunet}_{idx_pred}_pred_bin.nii"),
+                    'gt_path': os.path.join(scratch_dir, f"{dataset_name_nnunet}_{idx_gt}_gt_bin.nii"),
+                    'out_prefix': os.path.join(output_folder, f"{idx_pred}"),
+                    'flags': flags,
+                }],
+                'engine': engine,
+                'anima_binaries_path': anima_binaries_path,
+                'tolerance': tolerance,
+            })
+
+        results = run_cached_tasks(tasks, jobs, output_folder, use_cache)
 
         # Get all XML filepaths where ANIMA performance metrics are saved for each hold-out subject
-        subject_filepaths = [os.path.join(output_folder, f) for f in
-                                os.listdir(output_folder) if f.endswith('.xml')]
+        subject_filepaths = [f for _, xml_files, _ in results for f in xml_files]
         
         return subject_filepaths
 
 
-def main():
+def log_test_metrics(table, log_path, title):
+    """
+    Prints the mean and standard deviation of each metric of the metrics table (see metrics_table.py), and appends
+    them to the log file. Subjects with an empty GT and INF or NaN values are skipped.
+    """
+    valid_table = get_valid_metrics(table)
 
-    # get the ANIMA binaries path
-    cmd = r'''grep "^anima = " ~/.anima/config.txt | sed "s/.* = //"'''
-    
-    anima_binaries_path = subprocess.check_output(cmd, shell=True).decode('utf-8').strip('\n')
-    print('ANIMA Binaries Path:', anima_binaries_path)
-    # version = subprocess.check_output(anima_binaries_path + 'animaSegPerfAnalyzer --version', shell=True).decode('utf-8').strip('\n')
-    print('Running ANIMA version:',
-          subprocess.check_output(anima_binaries_path + 'animaSegPerfAnalyzer --version', shell=True).decode(
-              'utf-8').strip('\n'))
+    # Print aggregation of each metric via mean and standard dev.
+    with open(log_path, 'a') as f:
+        print(title, file=f)
+
+    print(title)
+    for key, values in valid_table.groupby('metric', observed=True, sort=False)['value']:
+        print('\t%s -> Mean: %0.4f Std: %0.2f' % (key, np.mean(values), np.std(values)))
+
+        # save the metrics to a log file
+        with open(log_path, 'a') as f:
+            print("\t%s --> Mean: %0.3f, Std: %0.3f" % (key, np.mean(values), np.std(values)), file=f)
+
+
+def main():
 
     parser = get_parser()
     args = parser.parse_args()
 
+    anima_binaries_path = None
+    if args.engine in ['anima', 'both']:
+        # get the ANIMA binaries path
+        cmd = r'''grep "^anima = " ~/.anima/config.txt | sed "s/.* = //"'''
+
+        anima_binaries_path = subprocess.check_output(cmd, shell=True).decode('utf-8').strip('\n')
+        print('ANIMA Binaries Path:', anima_binaries_path)
+        # version = subprocess.check_output(anima_binaries_path + 'animaSegPerfAnalyzer --version', shell=True).decode('utf-8').strip('\n')
+        print('Running ANIMA version:',
+              subprocess.check_output(anima_binaries_path + 'animaSegPerfAnalyzer --version', shell=True).decode(
+                  'utf-8').strip('\n'))
+
     # define variables
     pred_folder, gt_folder = args.pred_folder, args.gt_folder
     dataset_name = args.dataset_name
@@ -292,102 +623,43 @@ def main():
         os.makedirs(output_folder, exist_ok=True)
     print(f"Saving ANIMA performance metrics to {output_folder}")
 
+    if args.engine == 'native':
+        print("NOTE: the native engine does not compute the lesion detection metrics (PPVL, SensL, F1_score), "
+              "use --engine anima to get them")
+
+    # The log is rebuilt from all the (cached or new) per-subject metrics at each run
+    open(os.path.join(output_folder, f'log_{dataset_name}.txt'), 'w').close()
+
     if dataset_name not in REGION_BASED_DATASETS:
 
         # Get all XML filepaths where ANIMA performance metrics are saved for each hold-out subject
-        subject_filepaths = get_test_metrics_by_dataset(pred_folder, gt_folder, output_folder, anima_binaries_path, data_set=dataset_name, label_type=label_type)
+        subject_filepaths = get_test_metrics_by_dataset(pred_folder, gt_folder, output_folder, anima_binaries_path, data_set=dataset_name, label_type=label_type,
+                                                        engine=args.engine, tolerance=args.tolerance, jobs=args.jobs,
+                                                        tmp_dir=args.tmp_dir, use_cache=not args.no_cache)
         print("subject_filepaths")
         print(subject_filepaths)
-        test_metrics = defaultdict(list)
-
-        # Update the test metrics dictionary by iterating over all subjects
-        for subject_filepath in subject_filepaths:
-            print("Subject filepath:", subject_filepath)
-            subject = os.path.split(subject_filepath)[-1].split('_')[0]
-            root_node = ET.parse(source=subject_filepath).getroot()
-
-            # if GT is empty then metrics aren't calculated, hence the only entries in the XML file 
-            # NbTestedLesions and VolTestedLesions, both of which are zero. Hence, we can skip subjects
-            # with empty GTs by checked if the length of the .xml file is 2
-            if len(root_node) == 2:
-                print(f"Skipping Subject={int(subject):03d} ENTIRELY Due to Empty GT!")
-                continue
-
-            for metric in list(root_node):
-                name, value = metric.get('name'), float(metric.text)
+        table = build_metrics_table(subject_filepaths, method=dataset_name, label=label_type)
+        save_metrics_table(table, os.path.join(output_folder, TABLE_FILENAME))
 
-                if np.isinf(value) or np.isnan(value):
-                    print(f'Skipping Metric={name} for Subject={int(subject):03d} Due to INF or NaNs!')
-                    continue
-
-                test_metrics[name].append(value)
-
-        # Print aggregation of each metric via mean and standard dev.
-        with open(os.path.join(output_folder, f'log_{dataset_name}.txt'), 'a') as f:
-            print('Test Phase Metrics [ANIMA]: ', file=f)
-
-        print('Test Phase Metrics [ANIMA]: ')
-        for key in test_metrics:
-            print('\t%s -> Mean: %0.4f Std: %0.2f' % (key, np.mean(test_metrics[key]), np.std(test_metrics[key])))
-            
-            # save the metrics to a log file
-            with open(os.path.join(output_folder, f'log_{dataset_name}.txt'), 'a') as f:
-                        print("\t%s --> Mean: %0.3f, Std: %0.3f" % 
-                                (key, np.mean(test_metrics[key]), np.std(test_metrics[key])), file=f)
+        log_test_metrics(table, os.path.join(output_folder, f'log_{dataset_name}.txt'), 'Test Phase Metrics [ANIMA]: ')
         
     else:
         print("dataset name bien dans region based")
         # Get all XML filepaths where ANIMA performance metrics are saved for each hold-out subject
         subject_sc_filepaths, subject_gm_filepaths = \
             get_test_metrics_by_dataset(pred_folder, gt_folder, output_folder, anima_binaries_path,
-                                        data_set=dataset_name, label_type=label_type)
-        # loop through the sc and lesion filepaths and get the metrics
-        for subject_filepaths in [subject_sc_filepaths, subject_gm_filepaths]:
-        
-            test_metrics = defaultdict(list)
-            # Update the test metrics dictionary by iterating over all subjects
-            for subject_filepath in subject_filepaths:
-                
-                subject = os.path.split(subject_filepath)[-1].split('_')[0]
-                seg_type = os.path.split(subject_filepath)[-1].split('_')[1]
-                print(f"seg type {seg_type}")
-                root_node = ET.parse(source=subject_filepath).getroot()
-
-                # if GT is empty then metrics aren't calculated, hence the only entries in the XML file 
-                # NbTestedLesions and VolTestedLesions, both of which are zero. Hence, we can skip subjects
-                # with empty GTs by checked if the length of the .xml file is 2
-                if len(root_node) == 2:
-                    print(f"Skipping Subject={int(subject):03d} ENTIRELY Due to Empty GT!")
-                    continue
-
-                for metric in list(root_node):
-                    name, value = metric.get('name'), float(metric.text)
-
-                    if np.isinf(value) or np.isnan(value):
-                        print(f'Skipping Metric={name} for Subject={int(subject):03d} Due to INF or NaNs!')
-                        continue
-
-                    test_metrics[name].append(value)
-
-            # Print aggregation of each metric via mean and standard dev.
-            with open(os.path.join(output_folder, f'log_{dataset_name}.txt'), 'a') as f:
-                print(f'Test Phase Metrics [ANIMA] for {seg_type}: ', file=f)
-
-            print(f'Test Phase Metrics [ANIMA] for {seg_type}: ')
-            for key in test_metrics:
-                print('\t%s -> Mean: %0.4f Std: %0.2f' % (key, np.mean(test_metrics[key]), np.std(test_metrics[key])))
-            for key in test_metrics:
-                if key.startswith('SC_'):
-                    print(f'Spinal Cord {key} -> Mean: %0.4f Std: %0.2f' % (np.mean(test_metrics[key]), np.std(test_metrics[key])))
-            # Exemple de traitement pour "GM"
-            for key in test_metrics:
-                if key.startswith('GM_'):
-                    print(f'Grey Matter {key} -> Mean: %0.4f Std: %0.2f' % (np.mean(test_metrics[key]), np.std(test_metrics[key])))
-     
-            # save the metrics to a log file
-                with open(os.path.join(output_folder, f'log_{dataset_name}.txt'), 'a') as f:
-                            print("\t%s --> Mean: %0.3f, Std: %0.3f" % 
-                                    (key, np.mean(test_metrics[key]), np.std(test_metrics[key])), file=f)
+                                        data_set=dataset_name, label_type=label_type,
+                                        engine=args.engine, tolerance=args.tolerance, jobs=args.jobs,
+                                        tmp_dir=args.tmp_dir, use_cache=not args.no_cache)
+        table = pd.concat([build_metrics_table(subject_sc_filepaths, method=dataset_name, label='SC'),
+                           build_metrics_table(subject_gm_filepaths, method=dataset_name, label='GM')],
+                          ignore_index=True)
+        save_metrics_table(table, os.path.join(output_folder, TABLE_FILENAME))
+
+        # aggregate the SC and GM metrics separately
+        for seg_type in ['SC', 'GM']:
+            log_test_metrics(table[table['label'] == seg_type], os.path.join(output_folder, f'log_{dataset_name}.txt'),
+                             f'Test Phase Metrics [ANIMA] for {seg_type}: ')
 
 
 if __name__ == '__main__':
@@ -45,6 +45,14 @@ Usage example:
     python convert_bids_to_nnUNetv2.py --path-data ~/data/dataset --path-out ~/data/dataset-nnunet
                     --dataset-name MyDataset --dataset-number 501 --split 0.8 0.2 --seed 99 --copy False
 
+NOTE: With `--fuse-labels`, the SC and GM labels of each subject are fused into a single region-based label
+(SC=1, GM=2) named like the image without the channel suffix (e.g. MyDataset-sub-046_000.nii.gz), so that
+fusion_labels_GM_SC.py does not need to be run afterwards.
+
+NOTE: All the (subject, session, contrast) conversions are planned first, so that the train/test counters do not
+depend on the order in which the files are written. The files are then copied (or symlinked) by a pool of
+`--workers` threads.
+
 NOTE: In a multi-contrast setting, the script (and nnUNet) assumes that all subjects have all the contrast and 
 that the contrasts are co-registered. nnUNet cannot handle missing modalities. 
 
@@ -61,10 +69,17 @@ from pathlib import Path
 import json
 import os
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from loguru import logger
 from sklearn.model_selection import train_test_split
+import sys
 import numpy as np
+import nibabel as nib
+
+# fuse_labels is shared with fusion_labels_GM_SC.py, in vrac/add_mask_to_seg.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "vrac"))
+from add_mask_to_seg import fuse_labels
 
 
 def get_parser():
@@ -95,17 +110,173 @@ def get_parser():
     parser.add_argument('--copy', '-cp', type=bool, default=False,
                         help='If used, the files will be copied to the new structure. If not used, the symbolic links '
                              'will be created. Default: False. Example for copy: --copy True')
+    parser.add_argument('--splits-json', type=str, default=None,
+                        help='Path to a splits.json file saved by a previous conversion. If used, its train/test split '
+                             'is reused instead of being computed from --split and --seed. The split used is always '
+                             'saved in the output dataset as splits.json')
+    parser.add_argument('--fuse-labels', action='store_true',
+                        help='If used, the SC and GM labels are fused into a single region-based label (SC=1, GM=2) '
+                             'instead of being copied (or symlinked) as two files')
+    parser.add_argument('--workers', '-w', default=1, type=int,
+                        help='Number of threads used to copy (or symlink) the files to the new structure. Default: 1')
     return parser
 
 
-def convert_subject(root, subject, channel, contrast, label_suffix, data_type, path_out_images, path_out_labels, counter,
-                    list_images, list_labels, is_ses, copy, DS_name, session=None):
+def run_file_ops(file_ops, workers=1):
+    """Run the file operations planned by `convert_subject`, in a pool of `workers` threads if `workers` > 1.
+
+    Args:
+        file_ops (list): (function, arguments) pairs, e.g. (materialize_file, (src, dst, copy)).
+        workers (int): Number of threads.
+    """
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda file_op: file_op[0](*file_op[1]), file_ops))
+    else:
+        for function, arguments in file_ops:
+            function(*arguments)
+
+
+def materialize_file(src, dst, copy):
+    """Copy (copy=True) or symlink (copy=False) a file of the BIDS dataset to the nnUNet dataset.
+
+    Args:
+        src (str): Path to the file in the BIDS dataset.
+        dst (str): Path to the file in the nnUNet dataset.
+        copy (bool): The files in the nnUNet dataset need to be symlink of copy file (False: symlink, True: copy).
+    """
+    if copy:
+        shutil.copy2(os.path.abspath(src), dst)
+    else:
+        os.symlink(os.path.abspath(src), dst)
+
+
+def get_subject_splits(subjects, split, seed):
+    """Split the subjects into training and test sets.
+
+    Args:
+        subjects (list): Subject names.
+        split (list): Ratios of training and test splits.
+        seed (int): Seed used for the split.
+
+    Returns:
+        subject_splits (dict): {subject: 'train' or 'test'}.
+
+    """
+    # set the random number generator seed
+    rng = np.random.default_rng(seed)
+
+    train_ratio, test_ratio = split[0], split[1]
+    if test_ratio == 1:
+        test_subjects = subjects
+        train_subjects = []
+    elif train_ratio == 1:
+        train_subjects = subjects
+        test_subjects = []
+    else:
+        train_subjects, test_subjects = train_test_split(subjects, test_size=test_ratio, random_state=seed)
+        rng.shuffle(train_subjects)
+
+    subject_splits = {subject: 'train' for subject in train_subjects}
+    subject_splits.update({subject: 'test' for subject in test_subjects})
+    return subject_splits
+
+
+def save_subject_splits(subject_splits, path_json):
+    """Save the split as a JSON file {'train': [subjects], 'test': [subjects]}, readable by `load_subject_splits`."""
+    splits = {'train': [s for s, split in subject_splits.items() if split == 'train'],
+              'test': [s for s, split in subject_splits.items() if split == 'test']}
+    with open(path_json, 'w') as outfile:
+        json.dump(splits, outfile, indent=4)
+
+
+def load_subject_splits(path_json):
+    """Load a split saved by `save_subject_splits` as a dict {subject: 'train' or 'test'}."""
+    with open(path_json) as infile:
+        splits = json.load(infile)
+    return {subject: split for split in ['train', 'test'] for subject in splits[split]}
+
+
+def _list_dir(path):
+    """Return the entries of a directory as a dict {name: os.DirEntry} ({} if the directory does not exist)."""
+    try:
+        with os.scandir(path) as entries:
+            return {entry.name: entry for entry in entries}
+    except (FileNotFoundError, NotADirectoryError):
+        return {}
+
+
+def _get_file(entries, name):
+    """Return the path of the file `name` of a directory listed by `_list_dir`, or None if it does not exist.
+
+    `is_file()` follows symlinks, so dangling symlinks (e.g. git-annex files which were not fetched) are missing files,
+    as with `os.path.exists`.
+    """
+    entry = entries.get(name)
+    return entry.path if entry is not None and entry.is_file() else None
+
+
+def index_dataset(root, subjects, contrasts, data_type):
+    """Walk the BIDS dataset once with os.scandir and index the image and labels of each subject, session and contrast.
+
+    Args:
+        root (str): Path to BIDS dataset directory.
+        subjects (list): Subject names.
+        contrasts (list): Types of contrast.
+        data_type (str): Type of BIDS dataset used (anat, func, dwi...).
+
+    Returns:
+        index (dict): {subject: {session: {contrast: {'sub_name': str, 'image': str, 'SC': str, 'GM': str}}}} where
+            session is None for subjects without ses folders and missing files are None.
+
+    """
+    index = {}
+    for subject in subjects:
+        subject_entries = _list_dir(os.path.join(root, subject))
+        # Check if session folder(s) exist
+        if any('ses' in name for name in subject_entries):
+            sessions = sorted(name for name, entry in subject_entries.items() if entry.is_dir())
+        else:
+            sessions = [None]
+
+        index[subject] = {}
+        for session in sessions:
+            sub_ses = [subject] if session is None else [subject, session]
+            image_files = _list_dir(os.path.join(root, *sub_ses, data_type))
+            label_files = _list_dir(os.path.join(root, 'derivatives', 'labels', *sub_ses, data_type))
+            sub_name = '_'.join(sub_ses)
+
+            index[subject][session] = {}
+            for contrast in contrasts:
+                if session is not None:
+                    image_name = f"{sub_name}_{contrast}.nii.gz"
+                    label_names = {'SC': f"{sub_name}_{contrast}_SC.nii.gz", 'GM': f"{sub_name}_{contrast}_GM.nii.gz"}
+                else:
+                    if data_type == 'func':
+                        image_name = next((f for f in sorted(image_files)
+                                           if f.endswith('nii.gz') and image_files[f].is_file()), None)
+                        if image_name is not None:
+                            sub_name = re.match(r'^([^_]+)', image_name).group(1)
+                    else:
+                        image_name = f"{sub_name}_{contrast}.nii.gz"
+                    label_names = {'SC': f"{sub_name}_{contrast}_label-SC_seg.nii.gz",
+                                   'GM': f"{sub_name}_{contrast}_label-GM_seg.nii.gz"}
+
+                files = {'sub_name': sub_name, 'image': _get_file(image_files, image_name)}
+                for label, label_name in label_names.items():
+                    files[label] = _get_file(label_files, label_name)
+                index[subject][session][contrast] = files
+
+    return index
+
+
+def convert_subject(files, channel, contrast, label_suffix, path_out_images, path_out_labels, counter,
+                    list_images, list_labels, copy, DS_name, file_ops=None, fuse=False):
     """Function to get image from original BIDS dataset modify if needed and place
         it with a compatible name in nnUNet dataset.
 
     Args:
-        root (str): Path to BIDS dataset directory.
-        subject (str): Subject name.
+        files (dict): Image and labels of the subject, session and contrast, as indexed by `index_dataset`.
         contrast (str): Type of contrast.
         label_suffix (str): suffix of the label in derivatives.
         path_out_images (str): path to the images directory in the new dataset (test or train).
@@ -113,52 +284,22 @@ def convert_subject(root, subject, channel, contrast, label_suffix, data_type, p
         counter (int): counter for iterating through the number of subjects.
         list_images (list): List containing the paths of training/testing images in the nnUNetv2 format.
         list_labels (list): List containing the paths of training/testing labels in the nnUNetv2 format.
-        is_ses (bool): Whether or not the dataset has ses folders for each subject.
-        session (str): Session name or None if dataset without session.
         copy (bool): The files in the nnUNet dataset need to be symlink of copy file (False: symlink, True: copy).
         DS_name (str): Dataset name.
         channel (int): Contrast value as integer compatible with nnUNet documentation (ex: T1 = 1, T2 = 2, FLAIR = 3).
+        file_ops (list): If not None, the operations on the files are appended to this list as (function, arguments)
+            pairs instead of being run immediately, see `run_file_ops`.
+        fuse (bool): Whether to fuse the SC and GM labels into a single region-based label (see `fuse_labels`).
 
     Returns:
         list_images (list): List containing the paths of training/testing images in the nnUNetv2 format.
         list_labels (list): List containing the paths of training/testing labels in the nnUNetv2 format.
 
     """
-    if is_ses:
-        print("on a des sessions")
-        subject_image_file = os.path.join(root, subject, session, data_type, f"{subject}_{session}_{contrast}.nii.gz")
-       # subject_label_file = os.path.join(root, 'derivatives', 'labels', subject, session, data_type,
-         #                                 f"{subject}_{session}_{contrast}_{label_suffix}.nii.gz")
-        subject_label_file_SC = os.path.join(root, 'derivatives', 'labels', subject, session, data_type,
-                                          f"{subject}_{session}_{contrast}_SC.nii.gz")
-        subject_label_file_GM = os.path.join(root, 'derivatives', 'labels', subject, session, data_type,
-                                          f"{subject}_{session}_{contrast}_GM.nii.gz")
-        
-        sub_name = re.match(r'^([^_]+_[^_]+)', Path(subject_image_file).name).group(1)
-
-    elif data_type == 'func':
-        print(" on est dans data type = func")
-        subject_directory = os.path.join(root, subject, data_type)
-        all_files = os.listdir(subject_directory)
-        subject_image_file = os.path.join(subject_directory, [f for f in all_files if f.endswith('nii.gz')][0])
-        subject_label_directory = os.path.join(root, 'derivatives', 'labels', subject, data_type)
-        all_label_files = os.listdir(subject_label_directory)
-        subject_label_file = os.path.join(subject_label_directory, [f for f in all_label_files if f.endswith('nii.gz')][0])
-        sub_name = re.match(r'^([^_]+)', Path(subject_image_file).name).group(1)
-
-    else:
-        print("on est dans la derniere config")
-        subject_image_file = os.path.join(root, subject, data_type, f"{subject}_{contrast}.nii.gz")
-        #subject_label_file = os.path.join(root, 'derivatives', 'labels', subject, data_type,
-                          #                f"{subject}_{contrast}_{label_suffix}.nii.gz")
-        print(f"subject_image_file {subject_image_file}")
-        subject_label_file_SC = os.path.join(root, 'derivatives', 'labels', subject, data_type,
-                                          f"{subject}_{contrast}_label-SC_seg.nii.gz")
-        print(f"subject_label SC {subject_label_file_SC}")
-        subject_label_file_GM = os.path.join(root, 'derivatives', 'labels', subject, data_type,
-                                          f"{subject}_{contrast}_label-GM_seg.nii.gz")
-        print(f"subject_label GM {subject_label_file_GM}")
-        sub_name = re.match(r'^([^_]+)', Path(subject_image_file).name).group(1)
+    sub_name = files['sub_name']
+    subject_image_file = files['image']
+    subject_label_file_SC = files['SC']
+    subject_label_file_GM = files['GM']
 
     # if os.path.exists(subject_image_file):
     #     if label_suffix is not None:
@@ -184,28 +325,32 @@ def convert_subject(root, subject, channel, contrast, label_suffix, data_type, p
 
     # return list_images, list_labels
 
-    if os.path.exists(subject_image_file):
+    if subject_image_file is not None:
         if label_suffix is not None:
             print(f"LABEL {label_suffix}")
-            if os.path.exists(subject_label_file_SC) and os.path.exists(subject_label_file_GM):
+            if subject_label_file_SC is not None and subject_label_file_GM is not None:
                 print("on passe la condition")
-                subject_label_file_SC_nnunet = os.path.join(path_out_labels, f"{DS_name}-{sub_name}_{counter:03d}_SC.nii.gz")
-                subject_label_file_GM_nnunet = os.path.join(path_out_labels, f"{DS_name}-{sub_name}_{counter:03d}_GM.nii.gz")
-                list_labels.append(subject_label_file_SC_nnunet)
-                list_labels.append(subject_label_file_GM_nnunet)
+                if fuse:
+                    subject_label_file_nnunet = os.path.join(path_out_labels, f"{DS_name}-{sub_name}_{counter:03d}.nii.gz")
+                    list_labels.append(subject_label_file_nnunet)
+                    subject_file_ops = [(fuse_labels, (subject_label_file_SC, subject_label_file_GM,
+                                                       subject_label_file_nnunet))]
+                else:
+                    subject_label_file_SC_nnunet = os.path.join(path_out_labels, f"{DS_name}-{sub_name}_{counter:03d}_SC.nii.gz")
+                    subject_label_file_GM_nnunet = os.path.join(path_out_labels, f"{DS_name}-{sub_name}_{counter:03d}_GM.nii.gz")
+                    list_labels.append(subject_label_file_SC_nnunet)
+                    list_labels.append(subject_label_file_GM_nnunet)
+                    subject_file_ops = [(materialize_file, (subject_label_file_SC, subject_label_file_SC_nnunet, copy)),
+                                        (materialize_file, (subject_label_file_GM, subject_label_file_GM_nnunet, copy))]
                 # copy the files to new structure using symbolic links (prevents duplication of data and saves space)
                 subject_image_file_nnunet = os.path.join(path_out_images,
                                                          f"{DS_name}-{sub_name}_{counter:03d}_{channel:04d}.nii.gz")
                 list_images.append(subject_image_file_nnunet)
-                # copy the files to new structure using symbolic links (prevents duplication of data and saves space)
-                if copy:
-                    shutil.copy2(os.path.abspath(subject_label_file_SC), subject_label_file_SC_nnunet)
-                    shutil.copy2(os.path.abspath(subject_label_file_GM), subject_label_file_GM_nnunet)
-                    shutil.copy2(os.path.abspath(subject_image_file), subject_image_file_nnunet)
+                subject_file_ops.append((materialize_file, (subject_image_file, subject_image_file_nnunet, copy)))
+                if file_ops is not None:
+                    file_ops.extend(subject_file_ops)
                 else:
-                    os.symlink(os.path.abspath(subject_label_file_SC), subject_label_file_SC_nnunet)
-                    os.symlink(os.path.abspath(subject_label_file_GM), subject_label_file_GM_nnunet)
-                    os.symlink(os.path.abspath(subject_image_file), subject_image_file_nnunet)
+                    run_file_ops(subject_file_ops)
 
             else:
                 print(f"Labels for image {subject_image_file} do not exist for this {sub_name} and are ignored")
@@ -386,92 +531,59 @@ def main():
     pathlib.Path(path_out_labelsTr).mkdir(parents=True, exist_ok=True)
     pathlib.Path(path_out_labelsTs).mkdir(parents=True, exist_ok=True)
 
-    # set the random number generator seed
-    rng = np.random.default_rng(args.seed)
-
     # Get all subjects from participants.tsv
     subjects_df = pd.read_csv(os.path.join(root, 'participants.tsv'), sep='\t')
     subjects = subjects_df['participant_id'].values.tolist()
     logger.info(f"Total number of subjects in the dataset: {len(subjects)}")
 
-    # Get the training and test splits
-
-    train_ratio, test_ratio = args.split[0], args.split[1]
-    if test_ratio == 1:
-        test_subjects = subjects
-        train_subjects = []
-    elif train_ratio == 1:
-        train_subjects = subjects
-        test_subjects = []
+    # Get the training and test splits as a {subject: split} mapping
+    if args.splits_json is not None:
+        logger.info(f"Reusing the train/test split of {args.splits_json}")
+        subject_splits = load_subject_splits(args.splits_json)
     else:
-        train_subjects, test_subjects = train_test_split(subjects, test_size=test_ratio, random_state=args.seed)
-        rng.shuffle(train_subjects)
+        subject_splits = get_subject_splits(subjects, args.split, args.seed)
+    save_subject_splits(subject_splits, os.path.join(path_out, 'splits.json'))
 
     # Initialize counters for train and test subjects
     train_ctr, test_ctr = 0, 0
+    # operations on the files (copy, symlink or fusion), filled while planning the conversions
+    file_ops = []
+    # Index the images and labels of all the subjects (sessions and contrasts) at once
+    dataset_index = index_dataset(root, subjects, contrast_list, data_type)
+
     # Loop through all subjects
-    # TODO try to avoid duplication
     for subject in subjects:
+        split = subject_splits.get(subject)
 
         # Train subjects
-        if subject in train_subjects:
-
-            # Session folder(s) exist
-            # Check if session folder(s) exist
-            if any('ses' in folder for folder in os.listdir(os.path.join(root, subject))):
-                # Get all sessions for the subject
-                sessions = os.listdir(os.path.join(root, subject))
-                sessions.sort()
-
-                for session in sessions:
-                    train_ctr = len(train_images)
-                    for contrast in contrast_list:
-                        train_images, train_labels = convert_subject(root, subject, channel_dict[contrast], contrast,
-                                                                        label_suffix_dict[contrast], data_type, path_out_imagesTr, path_out_labelsTr,
-                                                                        train_ctr + test_ctr, train_images, train_labels,
-                                                                        True, copy, DS_name, session)
-
-
-            # No session folder(s) exist
-            else:
+        if split == 'train':
+            # Loop through the session folder(s), or a single `None` session if there is no session folder
+            for session, session_files in dataset_index[subject].items():
                 train_ctr = len(train_images)
                 for contrast in contrast_list:
-                    train_images, train_labels = convert_subject(root, subject, channel_dict[contrast], contrast,
-                                                                    label_suffix_dict[contrast], data_type, path_out_imagesTr, path_out_labelsTr,
-                                                                    train_ctr + test_ctr, train_images, train_labels,
-                                                                    False, copy, DS_name)
+                    train_images, train_labels = convert_subject(session_files[contrast], channel_dict[contrast], contrast,
+                                                                 label_suffix_dict[contrast], path_out_imagesTr, path_out_labelsTr,
+                                                                 train_ctr + test_ctr, train_images, train_labels,
+                                                                 copy, DS_name, file_ops, args.fuse_labels)
 
         # Test subjects
-        elif subject in test_subjects:
-            # Session folder(s) exist
-            # Check if session folder(s) exist
-            if any('ses' in folder for folder in os.listdir(os.path.join(root, subject))):
-                # Get all sessions for the subject
-                sessions = os.listdir(os.path.join(root, subject))
-                sessions.sort()
-
-                for session in sessions:
-                    test_ctr = len(test_images)
-                    for contrast in contrast_list:
-                        test_images, test_labels = convert_subject(root, subject, channel_dict[contrast], contrast,
-                                                                    label_suffix_dict[contrast], data_type, path_out_imagesTs, path_out_labelsTs,
-                                                                    train_ctr + test_ctr, test_images, test_labels, True,
-                                                                    copy, DS_name, session)
-
-
-            # No session folder(s) exist
-            else:
+        elif split == 'test':
+            # Loop through the session folder(s), or a single `None` session if there is no session folder
+            for session, session_files in dataset_index[subject].items():
                 test_ctr = len(test_images)
                 for contrast in contrast_list:
-                    test_images, test_labels = convert_subject(root, subject, channel_dict[contrast], contrast,
-                                                                    label_suffix_dict[contrast], data_type, path_out_imagesTs, path_out_labelsTs,
-                                                                    train_ctr + test_ctr, test_images, test_labels, False,
-                                                                    copy, DS_name)
-
+                    test_images, test_labels = convert_subject(session_files[contrast], channel_dict[contrast], contrast,
+                                                               label_suffix_dict[contrast], path_out_imagesTs, path_out_labelsTs,
+                                                               train_ctr + test_ctr, test_images, test_labels,
+                                                               copy, DS_name, file_ops, args.fuse_labels)
 
         else:
             print("Skipping file, could not be located in the Train or Test splits split.", subject)
 
+    # Copy (or symlink) or fuse all the planned files
+    logger.info(f"Writing {len(file_ops)} files with {args.workers} worker(s)")
+    run_file_ops(file_ops, args.workers)
+
     logger.info(f"Number of training and validation subjects (including sessions): {train_ctr}")
     logger.info(f"Number of test subjects (including sessions): {test_ctr}")
     # assert train_ctr == len(train_subjects), 'No. of train/val images do
@@ -525,10 +637,19 @@ def main():
 
     json_dict['channel_names'] = {v: k for k, v in channel_dict.items()}
 
-    json_dict['labels'] = {
-        "background": 0,
-        f"{contrast}": 1,
-    }
+    if args.fuse_labels:
+        # region-based training on the fused labels (SC=1, GM=2)
+        json_dict['labels'] = {
+            "background": 0,
+            "SC": [1, 2],
+            "GM": [2],
+        }
+        json_dict["regions_class_order"] = [1, 2]
+    else:
+        json_dict['labels'] = {
+            "background": 0,
+            f"{contrast}": 1,
+        }
 
     json_dict["numTraining"] = train_ctr + 1
     # Needed for finding the files correctly. IMPORTANT! File endings must match between images and segmentations!
@@ -1,27 +1,25 @@
 import os
+import sys
+
+# add_mask_to_seg.py et BIDSIFICATION se trouvent dans le dossier vrac
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "vrac"))
+# Même fusion que l'option --fuse-labels du script de conversion : SC seule = 1, GM = 2
+# (régions du dataset.json : "SC": [1, 2], "GM": [2])
+from add_mask_to_seg import find_pairs, batch_process_pairs, print_status_table, fuse_labels
 
 # Chemin vers le dossier contenant les masques de segmentation
 dossier_masques = "chemin/labelsTs"
 dossier_sortie = "chemin/resultats_fusion"
+# Nombre de processus utilisés pour la fusion
+nb_processus = os.cpu_count()
+
 
-# Parcours de tous les fichiers dans le dossier
-for fichier in os.listdir(dossier_masques):
-    if fichier.endswith("_SC.nii.gz"):
-        # Construction du chemin vers le fichier GM correspondant
-        fichier_gm = fichier.replace("_SC.nii.gz", "_GM.nii.gz")
-        chemin_sc = os.path.join(dossier_masques, fichier)
-        print(f"chemin sc {chemin_sc}")
-        chemin_gm = os.path.join(dossier_masques, fichier_gm)
-        print(f"chemin gm {chemin_gm}")
-        # Vérification de l'existence du fichier GM correspondant
-        if os.path.exists(chemin_gm):
-            # Construction de la commande pour fusionner les masques SC et GM
-            commande = f"python chemin/add_mask_to_seg.py  -i {chemin_sc} -seg {chemin_gm} -o {dossier_sortie} -val 2"
-            
-            # Exécution de la commande
-            os.system(commande)
-            print(f"Fusion effectuée pour {fichier}")
+if __name__ == "__main__":
+    os.makedirs(dossier_sortie, exist_ok=True)
 
-        else:
-            print(f"Attention: Aucun fichier GM correspondant trouvé pour {fichier}")
+    # Association de chaque fichier SC au fichier GM correspondant
+    paires = find_pairs(dossier_masques, dossier_sortie, mask_suffix="_SC.nii.gz", seg_suffix="_GM.nii.gz")
 
+    # Fusion des masques SC et GM (SC = 1, GM = 2), dans le même processus Python
+    statuts = batch_process_pairs(paires, fuse_labels, jobs=nb_processus)
+    print_status_table(statuts)
@@ -0,0 +1,117 @@
+"""
+Ingestion of the per-subject XML files written by "animaSegPerfAnalyzer" (or by seg_metrics.py) into a single
+columnar table with one row per (subject, label, method, metric) and the columns:
+    subject;    label;  method; metric; value
+
+The XML files are stream-parsed with `iterparse`, and the table can be persisted as a Parquet file
+(`metrics_table.parquet` in the "anima_stats" folder) so that the summary statistics of compute_anima_metrics_RB.py
+and the box plots of boxplot_comparison.py read one file instead of thousands of small XML files.
+
+NOTE: Parquet files require `pyarrow` (pip install pyarrow), see the installation steps of compute_anima_metrics_RB.py.
+"""
+
+import os
+import xml.etree.ElementTree as ET
+import numpy as np
+import pandas as pd
+
+
+TABLE_FILENAME = 'metrics_table.parquet'
+COLUMNS = ['subject', 'label', 'method', 'metric', 'value']
+# Only metrics reported by ANIMA when the GT is empty
+EMPTY_GT_METRICS = {'NbTestedLesions', 'VolTestedLesions'}
+
+
+def iter_xml_metrics(xml_path):
+    """
+    Stream-parses an ANIMA XML file.
+
+    :return: generator of (metric name, value)
+    """
+    for _, element in ET.iterparse(xml_path, events=('end',)):
+        if element.tag == 'measure':
+            yield element.get('name'), float(element.text)
+            element.clear()
+
+
+def parse_xml_filename(xml_path):
+    """
+    Gets the subject and label from the name of an XML file, e.g. `001_GM_global.xml` -> ('001', 'GM') and
+    `001_global.xml` -> ('001', '')
+    """
+    parts = os.path.basename(xml_path)[:-len('.xml')].split('_')
+    label = parts[1] if len(parts) > 2 else ''
+    return parts[0], label
+
+
+def build_metrics_table(xml_files, method='', label=None):
+    """
+    Builds the metrics table of a list of XML files.
+
+    :param xml_files: list of XML filepaths
+    :param method: name of the method (e.g. model or configuration) which produced the predictions
+    :param label: label of all the files. If None, the label is read from each filename (see `parse_xml_filename`)
+    :return: pandas DataFrame with the columns `COLUMNS`
+    """
+    columns = {column: [] for column in COLUMNS}
+    for xml_path in xml_files:
+        subject, file_label = parse_xml_filename(xml_path)
+        for metric, value in iter_xml_metrics(xml_path):
+            columns['subject'].append(subject)
+            columns['label'].append(file_label if label is None else label)
+            columns['method'].append(method)
+            columns['metric'].append(metric)
+            columns['value'].append(value)
+
+    table = pd.DataFrame(columns)
+    for column in ['label', 'method', 'metric']:
+        table[column] = table[column].astype('category')
+    return table
+
+
+def build_metrics_table_from_folder(xml_folder, method=''):
+    """
+    Returns the metrics table of a folder: read from its persisted table if it is more recent than all the XML files
+    of the folder, otherwise built from its XML files (e.g. XML files added or generated again after the table).
+    """
+    table_path = os.path.join(xml_folder, TABLE_FILENAME)
+    xml_files = sorted(os.path.join(xml_folder, f) for f in os.listdir(xml_folder) if f.endswith('.xml'))
+    if os.path.isfile(table_path) and \
+            all(os.path.getmtime(xml_path) <= os.path.getmtime(table_path) for xml_path in xml_files):
+        table = load_metrics_table(table_path)
+        table['method'] = pd.Categorical([method] * len(table))
+        return table
+
+    return build_metrics_table(xml_files, method=method)
+
+
+def save_metrics_table(table, table_path):
+    """
+    Saves the metrics table as a Parquet file. The table is not saved if `pyarrow` is not installed.
+    """
+    try:
+        table.to_parquet(table_path, index=False)
+    except ImportError as e:
+        print(f"Metrics table not saved to {table_path}: {e}")
+
+
+def load_metrics_table(table_path):
+    return pd.read_parquet(table_path)
+
+
+def get_valid_metrics(table):
+    """
+    Removes the subjects with an empty GT (only NbTestedLesions and VolTestedLesions are reported by ANIMA in this
+    case) and the INF or NaN values, which are both skipped when aggregating the metrics.
+    """
+    is_empty_gt = table.groupby(['label', 'subject'], observed=True)['metric'].agg(
+        lambda metrics: set(metrics) <= EMPTY_GT_METRICS)
+    empty_gt = is_empty_gt[is_empty_gt].index
+    for label, subject in empty_gt:
+        print(f"Skipping Subject={subject} {label} ENTIRELY Due to Empty GT!")
+    table = table[~pd.MultiIndex.from_frame(table[['label', 'subject']]).isin(empty_gt)]
+
+    is_finite = np.isfinite(table['value'])
+    for row in table[~is_finite].itertuples():
+        print(f'Skipping Metric={row.metric} for Subject={row.subject} {row.label} Due to INF or NaNs!')
+    return table[is_finite]
@@ -0,0 +1,218 @@
+"""
+In-process NumPy/SciPy implementation of the metrics reported by ANIMA's "animaSegPerfAnalyzer".
+
+The functions below take binary prediction and reference (GT) arrays and return the same measures,
+with the same names, as the XML files written by `animaSegPerfAnalyzer -X`:
+    - SEGMENTATION EVALUATION (-s):
+        Jaccard, Dice, Sensitivity, Specificity, PPV, NPV, RelativeVolumeError (in percentage)
+    - SURFACE DISTANCE EVALUATION (-d):
+        HausdorffDistance, ContourMeanDistance, SurfaceDistance
+
+The DETECTION LESIONS EVALUATION (-l: PPVL, SensL, F1_score) is NOT computed: ANIMA's alpha/beta/gamma detection
+rules with a minimal lesion volume in mm3 are not implemented, use ANIMA to get these metrics.
+
+When the GT is empty, only NbTestedLesions and VolTestedLesions are reported (as done by ANIMA).
+
+Definitions follow https://www.ncbi.nlm.nih.gov/pmc/articles/PMC6135867/pdf/41598_2018_Article_31911.pdf
+Undefined ratios (e.g. PPV of an empty prediction) are returned as NaN, so that they are skipped during
+aggregation exactly like the NaN/INF values written by ANIMA.
+
+Use `compare_metrics` to check the values against an XML file produced by ANIMA for the same pair. This module can
+also be run as a regression check against a reference ANIMA XML file (the script exits with an error on mismatch):
+    animaSegPerfAnalyzer -i pred.nii.gz -r gt.nii.gz -o ref -d -s -X
+    python seg_metrics.py --pred pred.nii.gz --gt gt.nii.gz --xml ref_global.xml
+"""
+
+import sys
+import argparse
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+import numpy as np
+from scipy import ndimage
+
+
+SEGMENTATION_METRICS = ['Jaccard', 'Dice', 'Sensitivity', 'Specificity', 'PPV', 'NPV', 'RelativeVolumeError']
+SURFACE_METRICS = ['HausdorffDistance', 'ContourMeanDistance', 'SurfaceDistance']
+DETECTION_METRICS = ['PPVL', 'SensL', 'F1_score']
+EMPTY_GT_METRICS = ['NbTestedLesions', 'VolTestedLesions']
+
+
+def _ratio(num, den):
+    return float(num) / den if den != 0 else np.nan
+
+
+def _connectivity(ndim):
+    # full connectivity (26-neighbourhood in 3D), same structuring element as keep_largest_component.py
+    return ndimage.generate_binary_structure(ndim, ndim)
+
+
+def compute_segmentation_metrics(pred, gt):
+    """
+    Compute the voxel-wise overlap metrics from the confusion matrix of two binary arrays.
+
+    :param pred: binary prediction array
+    :param gt: binary reference array of the same shape
+    :return: OrderedDict {metric name: value}
+    """
+    tp = np.count_nonzero(pred & gt)
+    n_pred = np.count_nonzero(pred)
+    n_gt = np.count_nonzero(gt)
+    fp = n_pred - tp
+    fn = n_gt - tp
+    tn = pred.size - tp - fp - fn
+
+    metrics = OrderedDict()
+    metrics['Jaccard'] = _ratio(tp, tp + fp + fn)
+    metrics['Dice'] = _ratio(2 * tp, 2 * tp + fp + fn)
+    metrics['Sensitivity'] = _ratio(tp, tp + fn)
+    metrics['Specificity'] = _ratio(tn, tn + fp)
+    metrics['PPV'] = _ratio(tp, tp + fp)
+    metrics['NPV'] = _ratio(tn, tn + fn)
+    metrics['RelativeVolumeError'] = _ratio(100 * (n_pred - n_gt), n_gt)
+    return metrics
+
+
+def _surface(mask):
+    # boundary voxels: voxels of the mask with at least one (face-connected) background neighbour
+    structure = ndimage.generate_binary_structure(mask.ndim, 1)
+    return mask & ~ndimage.binary_erosion(mask, structure=structure, border_value=0)
+
+
+def compute_surface_metrics(pred, gt, spacing=None):
+    """
+    Compute the surface distance metrics between the contours of two binary arrays.
+
+    The distance transform is only computed on the bounding box of both masks (padded by one voxel), which
+    gives the same distances as on the full volume since all the contour voxels lie inside this box.
+
+    :param pred: binary prediction array
+    :param gt: binary reference array of the same shape
+    :param spacing: voxel size along each axis. Default: 1 (distances in voxels)
+    :return: OrderedDict {metric name: value}
+    """
+    metrics = OrderedDict((name, np.nan) for name in SURFACE_METRICS)
+    if not pred.any() or not gt.any():
+        return metrics
+
+    # crop to the bounding box of the union
+    bbox = ndimage.find_objects((pred | gt).astype(np.uint8))[0]
+    bbox = tuple(slice(max(s.start - 1, 0), s.stop + 1) for s in bbox)
+    surface_pred = _surface(pred[bbox])
+    surface_gt = _surface(gt[bbox])
+
+    dist_pred_to_gt = ndimage.distance_transform_edt(~surface_gt, sampling=spacing)[surface_pred]
+    dist_gt_to_pred = ndimage.distance_transform_edt(~surface_pred, sampling=spacing)[surface_gt]
+
+    metrics['HausdorffDistance'] = float(max(dist_pred_to_gt.max(), dist_gt_to_pred.max()))
+    metrics['ContourMeanDistance'] = float((dist_pred_to_gt.mean() + dist_gt_to_pred.mean()) / 2)
+    metrics['SurfaceDistance'] = float((dist_pred_to_gt.sum() + dist_gt_to_pred.sum()) /
+                                       (dist_pred_to_gt.size + dist_gt_to_pred.size))
+    return metrics
+
+
+def compute_metrics(pred, gt, spacing=None, segmentation=True, distance=True):
+    """
+    Compute the metrics of "animaSegPerfAnalyzer" for a prediction and its reference.
+
+    :param pred: binary prediction array
+    :param gt: binary reference array of the same shape
+    :param spacing: voxel size along each axis, used for the surface distances. Default: 1 (voxels)
+    :param segmentation: compute the segmentation metrics (ANIMA flag -s)
+    :param distance: compute the surface distance metrics (ANIMA flag -d)
+    :return: OrderedDict {metric name: value}, ordered as in ANIMA's XML files
+    """
+    pred = np.asarray(pred).astype(bool, copy=False)
+    gt = np.asarray(gt).astype(bool, copy=False)
+    if pred.shape != gt.shape:
+        raise ValueError(f'Prediction and GT should have the same shape, got {pred.shape} and {gt.shape}')
+
+    metrics = OrderedDict()
+    # if GT is empty, metrics aren't calculated and only the tested lesions are reported
+    if not gt.any():
+        metrics['NbTestedLesions'] = float(ndimage.label(pred, _connectivity(pred.ndim))[1])
+        voxel_volume = np.prod(spacing) if spacing is not None else 1.0
+        metrics['VolTestedLesions'] = float(np.count_nonzero(pred) * voxel_volume)
+        return metrics
+
+    if segmentation:
+        metrics.update(compute_segmentation_metrics(pred, gt))
+    if distance:
+        metrics.update(compute_surface_metrics(pred, gt, spacing))
+    return metrics
+
+
+def write_anima_xml(metrics, xml_path, name=''):
+    """
+    Save the metrics in the same XML layout as `animaSegPerfAnalyzer -X`.
+    """
+    root_node = ET.Element('image', name=name)
+    for metric, value in metrics.items():
+        ET.SubElement(root_node, 'measure', name=metric).text = repr(float(value))
+    ET.ElementTree(root_node).write(xml_path, encoding='UTF-8', xml_declaration=True)
+
+
+def read_anima_xml(xml_path):
+    """
+    :return: OrderedDict {metric name: value} read from an XML file written by ANIMA or `write_anima_xml`
+    """
+    root_node = ET.parse(source=xml_path).getroot()
+    return OrderedDict((metric.get('name'), float(metric.text)) for metric in root_node)
+
+
+def read_anima_xml_name(xml_path):
+    """
+    :return: name of the evaluated image stored in an XML file written by ANIMA or `write_anima_xml`
+    """
+    return ET.parse(source=xml_path).getroot().get('name', '')
+
+
+def compare_metrics(metrics, reference, tolerance=1e-3):
+    """
+    Compare metrics with reference values (typically read from an ANIMA XML file).
+
+    :param tolerance: absolute and relative tolerance. NaN and INF values are considered equal to each other.
+    :return: dict {metric name: (value, reference value)} of the metrics that differ
+    """
+    mismatches = {}
+    for name, ref_value in reference.items():
+        value = metrics.get(name, np.nan)
+        if not np.isfinite(value) and not np.isfinite(ref_value):
+            continue
+        if not np.isclose(value, ref_value, rtol=tolerance, atol=tolerance):
+            mismatches[name] = (value, ref_value)
+    return mismatches
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Check the native metrics of a prediction/GT pair against the XML '
+                                                 'file written by animaSegPerfAnalyzer for the same pair.')
+    parser.add_argument('--pred', required=True, type=str, help='Binary prediction (NIfTI) given to ANIMA')
+    parser.add_argument('--gt', required=True, type=str, help='Binary GT (NIfTI) given to ANIMA')
+    parser.add_argument('--xml', required=True, type=str, help='Reference XML file written by animaSegPerfAnalyzer -X')
+    parser.add_argument('--tolerance', default=1e-3, type=float,
+                        help='Absolute and relative tolerance of the comparison. Default: 1e-3')
+    return parser
+
+
+def main():
+    import nibabel as nib
+
+    args = get_parser().parse_args()
+    pred_nib = nib.load(args.pred)
+    pred = np.asanyarray(pred_nib.dataobj) > 0.5
+    gt = np.asanyarray(nib.load(args.gt).dataobj) > 0.5
+    # ANIMA computes the surface distances in mm, with the voxel size of the images
+    spacing = pred_nib.header.get_zooms()[:pred.ndim]
+
+    reference = {name: value for name, value in read_anima_xml(args.xml).items() if name not in DETECTION_METRICS}
+    metrics = compute_metrics(pred, gt, spacing=spacing)
+    mismatches = compare_metrics(metrics, reference, tolerance=args.tolerance)
+    for name in reference:
+        value, ref_value = metrics.get(name, np.nan), reference[name]
+        print(f"{'MISMATCH' if name in mismatches else 'OK':<8} {name:<20} native={value:.6f}, ANIMA={ref_value:.6f}")
+    if mismatches:
+        sys.exit(f'{len(mismatches)} metrics differ from ANIMA by more than {args.tolerance}')
+
+
+if __name__ == '__main__':
+    main()
@@ -371,13 +371,13 @@ def main():
                     if img_type.startswith('LABEL'):
                         # Load raw image
                         img_path = sub_dict['IMAGE']['path_file_in']
-                        img = Image(img_path)
+                        img = Image(img_path, lazy=True) # Only the header is needed
                         orientation_img = img.orientation
 
                         # Load mask data
                         path_mask_in = dict_paths['path_file_in']
                         path_mask_out = dict_paths['path_file_out']
-                        mask = Image(path_mask_in)
+                        mask = Image(path_mask_in, lazy=True)
                         orientation_mask = mask.orientation
 
                         # Check orientation
@@ -386,7 +386,7 @@ def main():
                             mask.change_orientation(orientation_img)
 
                         # Check image dimensions
-                        if not img.data.shape == mask.data.shape:
+                        if not img.shape == mask.shape:
                             raise ValueError(f"{img_path} and {path_mask_in} have different dimensions !")
 
                         # Add files to QC
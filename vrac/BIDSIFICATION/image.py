@@ -2,23 +2,32 @@ import os
 import numpy as np
 import nibabel as nib
 import logging
+from collections import Counter
 from copy import deepcopy
 
 logger = logging.getLogger(__name__)
 
+# Number of times the cached header-derived properties of `Image` (orientation, dim) were computed, for profiling
+recompute_counts = Counter()
+
 class Image(object):
     """
     Compact version of SCT's Image Class (https://github.com/spinalcordtoolbox/spinalcordtoolbox/blob/master/spinalcordtoolbox/image.py#L245)
     Create an object that behaves similarly to nibabel's image object. Useful additions include: dims, change_orientation and getNonZeroCoordinates.
     """
 
-    def __init__(self, param=None, hdr=None, orientation=None, absolutepath=None, dim=None):
+    def __init__(self, param=None, hdr=None, orientation=None, absolutepath=None, dim=None, lazy=False):
         """
         :param param: string indicating a path to a image file or an `Image` object.
+        :param lazy: when loading from a file, only read the header: the voxels are decoded on the first access to\
+                     `data`. Header-only properties (`dim`, `orientation`, `affine`, `shape`) and `get_data_slice`\
+                     do not decode the whole volume.
         """
 
         # initialization of all parameters
+        self._header_cache = {}
         self.affine = None
+        self._dataobj = None
         self.data = None
         self._path = None
         self.ext = ""
@@ -28,7 +37,7 @@ class Image(object):
         
         # Case 1: load an image from file
         if isinstance(param, str):
-            self.loadFromPath(param)
+            self.loadFromPath(param, lazy=lazy)
         # Case 2: create a copy of an existing `Image` object
         elif isinstance(param, type(self)):
             self.copy(param)
@@ -46,15 +55,63 @@ class Image(object):
             raise TypeError('Image constructor takes at least one argument.')
     
         # Fix any mismatch between the array's datatype and the header datatype
-        self.fix_header_dtype()
+        # (in lazy mode, it is done when saving since the array is not decoded yet)
+        if not self.is_lazy:
+            self.fix_header_dtype()
+
+    @property
+    def data(self):
+        if self._data is None and self._dataobj is not None:
+            # lazy mode: decode the whole array on first access
+            self._data = np.asanyarray(self._dataobj)
+            self._dataobj = None
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._dataobj = None
+
+    @property
+    def is_lazy(self):
+        """
+        True if the voxels were not decoded yet
+        """
+        return self._dataobj is not None
+
+    @property
+    def shape(self):
+        return self.hdr.get_data_shape() if self.is_lazy else self.data.shape
+
+    def get_data_slice(self, key):
+        """
+        Return `data[key]`. In lazy mode, only the requested region is read from the file (through nibabel's dataobj).
+        """
+        if self.is_lazy:
+            return np.asanyarray(self._dataobj[key])
+        return self.data[key]
+
+    def _get_header_cached(self, name, compute):
+        """
+        Return `compute(self)`, memoised until the content of the header changes (the value only depends on the header,
+        which may be replaced or modified in-place, e.g. by `change_orientation` or `save`).
+        """
+        key = self.hdr.binaryblock
+        cached = self._header_cache.get(name)
+        if cached is None or cached[0] != key:
+            recompute_counts[name] += 1
+            logger.debug("Computing %s of %s", name, self._path)
+            cached = (key, compute(self))
+            self._header_cache[name] = cached
+        return cached[1]
 
     @property
     def dim(self):
-        return get_dimension(self)
+        return self._get_header_cached('dim', get_dimension)
     
     @property
     def orientation(self):
-        return get_orientation(self)
+        return self._get_header_cached('orientation', get_orientation)
     
     @property
     def absolutepath(self):
@@ -105,25 +162,30 @@ class Image(object):
         else:
             return deepcopy(self)
 
-    def loadFromPath(self, path):
+    def loadFromPath(self, path, lazy=False):
         """
         This function load an image from an absolute path using nibabel library
 
         :param path: path of the file from which the image will be loaded
+        :param lazy: only keep nibabel's array proxy, the voxels are decoded on the first access to `data`
         :return:
         """
 
         self.absolutepath = os.path.abspath(path)
         im_file = nib.load(self.absolutepath, mmap=True)
         self.affine = im_file.affine.copy()
-        self.data = np.asanyarray(im_file.dataobj)
+        if lazy:
+            self.data = None
+            self._dataobj = im_file.dataobj
+        else:
+            self.data = np.asanyarray(im_file.dataobj)
         self.hdr = im_file.header.copy()
         if path != self.absolutepath:
-            logger.debug("Loaded %s (%s) orientation %s shape %s", path, self.absolutepath, self.orientation, self.data.shape)
+            logger.debug("Loaded %s (%s) orientation %s shape %s", path, self.absolutepath, self.orientation, im_file.shape)
         else:
-            logger.debug("Loaded %s orientation %s shape %s", path, self.orientation, self.data.shape)
+            logger.debug("Loaded %s orientation %s shape %s", path, self.orientation, im_file.shape)
 
-    def change_orientation(self, orientation, inverse=False):
+    def change_orientation(self, orientation, inverse=False, copy=False):
         """
         Change orientation on image (in-place).
 
@@ -133,8 +195,10 @@ class Image(object):
                         want to transform *from* the specified orientation, not *to*\
                         it.
 
+        :param copy: make a contiguous copy of the data instead of a view
+
         """
-        change_orientation(self, orientation, self, inverse=inverse)
+        change_orientation(self, orientation, self, inverse=inverse, copy=copy)
         return self
     
     def getNonZeroCoordinates(self, sorting=None, reverse_coord=False):
@@ -143,7 +207,24 @@ class Image(object):
         Coordinate list can also be sorted by x, y, z, or the value with the parameter sorting='x', sorting='y', sorting='z' or sorting='value'
         If reverse_coord is True, coordinate are sorted from larger to smaller.
 
-        Removed Coordinate object
+        Removed Coordinate object. List version of `getNonZeroCoordinatesArray`.
+        """
+        coordinates, values = self._get_non_zero_coordinates(sorting, reverse_coord)
+        return [[x, y, z, value] for (x, y, z), value in zip(coordinates.tolist(), values.tolist())]
+
+    def getNonZeroCoordinatesArray(self, sorting=None, reverse_coord=False):
+        """
+        Same as `getNonZeroCoordinates`, vectorized.
+
+        :return: (N, 4) array of [x, y, z, value], with the dtype of the image data if it can represent the coordinates
+        """
+        coordinates, values = self._get_non_zero_coordinates(sorting, reverse_coord)
+        return np.column_stack((coordinates.astype(np.result_type(coordinates, values)), values))
+
+    def _get_non_zero_coordinates(self, sorting=None, reverse_coord=False):
+        """
+        :return: (N, 3) array of the coordinates and (N,) array of the values of the non-zero voxels, in the order of
+        `getNonZeroCoordinates`
         """
         n_dim = 1
         if self.dim[3] == 1:
@@ -152,35 +233,33 @@ class Image(object):
             n_dim = 4
         if self.dim[2] == 1:
             n_dim = 2
-
+        if n_dim == 4:
+            raise ValueError('getNonZeroCoordinates only supports 2D and 3D images')
+
+        nonzero = (self.data > 0).nonzero()
+        values = self.data[nonzero]
+        coordinates = np.zeros((len(values), 3), dtype=np.intp)
+        coordinates[:, 0] = nonzero[0]
+        coordinates[:, 1] = nonzero[1]
         if n_dim == 3:
-            X, Y, Z = (self.data > 0).nonzero()
-            list_coordinates = [[X[i], Y[i], Z[i], self.data[X[i], Y[i], Z[i]]] for i in range(0, len(X))]
-        elif n_dim == 2:
-            try:
-                X, Y = (self.data > 0).nonzero()
-                list_coordinates = [[X[i], Y[i], 0, self.data[X[i], Y[i]]] for i in range(0, len(X))]
-            except ValueError:
-                X, Y, Z = (self.data > 0).nonzero()
-                list_coordinates = [[X[i], Y[i], 0, self.data[X[i], Y[i], 0]] for i in range(0, len(X))]
+            coordinates[:, 2] = nonzero[2]
 
         if sorting is not None:
             if reverse_coord not in [True, False]:
                 raise ValueError('reverse_coord parameter must be a boolean')
+            if sorting not in ['x', 'y', 'z', 'value']:
+                raise ValueError("sorting parameter must be either 'x', 'y', 'z' or 'value'")
 
-            if sorting == 'x':
-                list_coordinates = sorted(list_coordinates, key=lambda el: el[0], reverse=reverse_coord)
-            elif sorting == 'y':
-                list_coordinates = sorted(list_coordinates, key=lambda el: el[1], reverse=reverse_coord)
-            elif sorting == 'z':
-                list_coordinates = sorted(list_coordinates, key=lambda el: el[2], reverse=reverse_coord)
-            elif sorting == 'value':
-                list_coordinates = sorted(list_coordinates, key=lambda el: el[3], reverse=reverse_coord)
+            key = values if sorting == 'value' else coordinates[:, 'xyz'.index(sorting)]
+            if reverse_coord:
+                # descending order, equal elements keep their original order (as sorted(..., reverse=True))
+                order = len(key) - 1 - np.argsort(key[::-1], kind='stable')[::-1]
             else:
-                raise ValueError("sorting parameter must be either 'x', 'y', 'z' or 'value'")
+                order = np.argsort(key, kind='stable')
+            coordinates, values = coordinates[order], values[order]
+
+        return coordinates, values
 
-        return list_coordinates
-    
     def change_type(self, dtype):
         """
         Change data type on image.
@@ -273,19 +352,34 @@ class Image(object):
                 self.hdr.set_data_shape(self.data.shape)
                 self.fix_header_dtype()
 
-            # nb. that copy() is important because if it were a memory map, save() would corrupt it
-            dataobj = self.data.copy()
+            # nb. the copy is important if the data is a memory map of the file being written, save() would corrupt it
+            dataobj = self.data.copy() if is_memmap_of(self.data, self.absolutepath) else self.data
             affine = None
             header = self.hdr.copy() if self.hdr is not None else None
             nib.save(nib.nifti1.Nifti1Image(dataobj, affine, header), self.absolutepath)
             if not os.path.isfile(self.absolutepath):
                 raise RuntimeError(f"Couldn't save image to {self.absolutepath}")
         else:
-            # if we're not operating in-place, then make any required modifications on a throw-away copy
-            self.copy().save(path, dtype, verbose, mutable=True)
+            # if we're not operating in-place, then make any required modifications on a throw-away image sharing
+            # the data array (change_type never modifies the array in-place) with a copy of the header
+            im_tmp = Image(self.data, hdr=self.hdr)
+            im_tmp.affine = self.affine
+            im_tmp._path = self._path
+            im_tmp.save(path, dtype, verbose, mutable=True)
         return self
 
 
+def is_memmap_of(data, path):
+    """
+    Check if an array (or the array it is a view of) is a memory map of the file `path`.
+    """
+    while data is not None:
+        if isinstance(data, np.memmap) and data.filename is not None:
+            return os.path.exists(path) and os.path.samefile(data.filename, path)
+        data = getattr(data, 'base', None)
+    return False
+
+
 class SlicerOneAxis(object):
     """
     Image slicer to use when you don't care about the 2D slice orientation,
@@ -343,7 +437,7 @@ class SlicerOneAxis(object):
         if self.direction == -1:
             idx = self.nb_slices - 1 - idx
 
-        return self.im.data[self._slice(idx)]
+        return self.im.get_data_slice(self._slice(idx))
 
 def get_dimension(im_file, verbose=1):
     """
@@ -367,7 +461,7 @@ def get_dimension(im_file, verbose=1):
     return *ndims, *pdims
 
 
-def change_orientation(im_src, orientation, im_dst=None, inverse=False):
+def change_orientation(im_src, orientation, im_dst=None, inverse=False, copy=False):
     """
     Copied from https://github.com/spinalcordtoolbox/spinalcordtoolbox/
 
@@ -377,11 +471,14 @@ def change_orientation(im_src, orientation, im_dst=None, inverse=False):
                    operation, can be unset to generate one)
     :param inverse: if you think backwards, use this to specify that you actually
                     want to transform *from* the specified orientation, not *to* it.
+    :param copy: if True, the data of the resulting image is a contiguous copy instead of a view of the source data
     :return: an image with changed orientation
 
     .. note::
         - the resulting image has no path member set
         - if the source image is < 3D, it is reshaped to 3D and the destination is 3D
+        - unless `copy`, the data of the resulting image is a (non-contiguous) view of the source data: changing the
+          orientation is O(1), the data is only made contiguous when saved
     """
 
     if len(im_src.data.shape) < 3:
@@ -403,36 +500,21 @@ def change_orientation(im_src, orientation, im_dst=None, inverse=False):
     perm, inversion = _get_permutations(im_src_orientation, im_dst_orientation)
 
     if im_dst is None:
-        im_dst = im_src.copy()
-        im_dst._path = None
+        # only the header is copied, the data is replaced below
+        im_dst = Image(im_src.data, hdr=im_src.hdr)
+        im_dst.affine = deepcopy(im_src.affine)
 
     im_src_data = im_src.data
     if len(im_src_data.shape) < 3:
         im_src_data = im_src_data.reshape(tuple(list(im_src_data.shape) + ([1] * (3 - len(im_src_data.shape)))))
 
-    # Update data by performing inversions and swaps
-
-    # axes inversion (flip)
-    data = im_src_data[::inversion[0], ::inversion[1], ::inversion[2]]
-
-    # axes manipulations (transpose)
-    if perm == [1, 0, 2]:
-        data = np.swapaxes(data, 0, 1)
-    elif perm == [2, 1, 0]:
-        data = np.swapaxes(data, 0, 2)
-    elif perm == [0, 2, 1]:
-        data = np.swapaxes(data, 1, 2)
-    elif perm == [2, 0, 1]:
-        data = np.swapaxes(data, 0, 2)  # transform [2, 0, 1] to [1, 0, 2]
-        data = np.swapaxes(data, 0, 1)  # transform [1, 0, 2] to [0, 1, 2]
-    elif perm == [1, 2, 0]:
-        data = np.swapaxes(data, 0, 2)  # transform [1, 2, 0] to [0, 2, 1]
-        data = np.swapaxes(data, 1, 2)  # transform [0, 2, 1] to [0, 1, 2]
-    elif perm == [0, 1, 2]:
-        # do nothing
-        pass
-    else:
-        raise NotImplementedError()
+    # Update data with a single strided view: inversions (flip) of the spatial axes, then permutation (transpose)
+    # of the spatial axes, the other axes (time, vector components) are left unchanged
+    flip = tuple(slice(None, None, i) for i in inversion)
+    axes = list(np.argsort(perm)) + list(range(3, im_src_data.ndim))
+    data = im_src_data[flip].transpose(axes)
+    if copy:
+        data = data.copy()
 
     # Update header
 
@@ -473,6 +555,16 @@ def _get_permutations(im_src_orientation, im_dst_orientation):
     return perm, inversion
 
 
+def get_permutations(im_src_orientation, im_dst_orientation):
+    """
+    :param im_src_orientation str: Orientation of source image. Example: 'RPI'
+    :param im_dst_orientation str: Orientation of destination image. Example: 'SAL'
+    :return: (perm, inversion): perm[i] is the destination axis of the source axis i, and inversion[i] is -1 if this
+             axis is flipped (1 otherwise), as applied by `change_orientation`
+    """
+    return _get_permutations(im_src_orientation, im_dst_orientation)
+
+
 def get_orientation(im):
     """
     Copied from https://github.com/spinalcordtoolbox/spinalcordtoolbox/
@@ -538,34 +630,19 @@ def change_type(im_src, dtype, im_dst=None):
         # check if voxel values are real or integer
         isInteger = True
         if dtype == 'minimize':
-            for vox in im_src.data.flatten():
-                if int(vox) != vox:
-                    isInteger = False
-                    break
+            isInteger = is_integer_valued(im_src.data)
 
         if isInteger:
             if min_in >= 0:  # unsigned
-                if max_in <= np.iinfo(np.uint8).max:
-                    dtype = np.uint8
-                elif max_in <= np.iinfo(np.uint16):
-                    dtype = np.uint16
-                elif max_in <= np.iinfo(np.uint32).max:
-                    dtype = np.uint32
-                elif max_in <= np.iinfo(np.uint64).max:
-                    dtype = np.uint64
-                else:
-                    raise ValueError("Maximum value of the image is to big to be represented.")
+                candidates = [np.uint8, np.uint16, np.uint32, np.uint64]
             else:
-                if max_in <= np.iinfo(np.int8).max and min_in >= np.iinfo(np.int8).min:
-                    dtype = np.int8
-                elif max_in <= np.iinfo(np.int16).max and min_in >= np.iinfo(np.int16).min:
-                    dtype = np.int16
-                elif max_in <= np.iinfo(np.int32).max and min_in >= np.iinfo(np.int32).min:
-                    dtype = np.int32
-                elif max_in <= np.iinfo(np.int64).max and min_in >= np.iinfo(np.int64).min:
-                    dtype = np.int64
-                else:
-                    raise ValueError("Maximum value of the image is to big to be represented.")
+                candidates = [np.int8, np.int16, np.int32, np.int64]
+            for candidate in candidates:
+                if np.iinfo(candidate).min <= min_in and max_in <= np.iinfo(candidate).max:
+                    dtype = candidate
+                    break
+            else:
+                raise ValueError("Maximum value of the image is to big to be represented.")
         else:
             # if max_in <= np.finfo(np.float16).max and min_in >= np.finfo(np.float16).min:
             #    type = 'np.float16' # not supported by nibabel
@@ -593,11 +670,28 @@ def change_type(im_src, dtype, im_dst=None):
                 im_dst.data = data_rescaled - (data_rescaled.min() - min_out)
 
     # change type of data in both numpy array and nifti header
-    im_dst.data = getattr(np, dtype.name)(im_dst.data)
+    im_dst.data = im_dst.data.astype(dtype, copy=False)
     im_dst.hdr.set_data_dtype(dtype)
     return im_dst
 
 
+def is_integer_valued(data, chunk_size=2**22):
+    """
+    Check if all the values of an array are integers, by chunks of about `chunk_size` values along the first axis to
+    bound the memory of the temporary arrays. NaN and INF values are not integers.
+    """
+    data = np.asanyarray(data)
+    if data.dtype == bool or np.issubdtype(data.dtype, np.integer):
+        return True
+    if data.ndim == 0:
+        return bool(np.mod(data, 1) == 0)
+    step = max(1, chunk_size // max(1, data[0].size))
+    for i in range(0, data.shape[0], step):
+        if not np.all(np.mod(data[i:i + step], 1) == 0):
+            return False
+    return True
+
+
 def to_dtype(dtype):
     """
     Take a dtypeification and return an np.dtype
@@ -1,16 +1,26 @@
 import os
+import csv
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+import nibabel as nib
 from BIDSIFICATION.image import Image
 
 
 def get_parser():
     # parse command line arguments
-    parser = argparse.ArgumentParser(description='Add a binary masked region to an existing segmentation file. The pixel values are set using the flag "-val".')
-    parser.add_argument('-i', type=str, help='Input binary mask. Example: sub-001_T2w_label-sacrum_seg.nii.gz', required=True)
-    parser.add_argument('-seg', type=str, help='Existing segmentation where the mask will be added. Example: sub-001_T2w_label-totalseg_dseg.nii.gz', required=True)
-    parser.add_argument('-o', type=str, help='Output path where the final segmentation will be stored. Example: sub-001_T2w_label-totalseg_dseg.nii.gz', required=True)
+    parser = argparse.ArgumentParser(description='Add a binary masked region to an existing segmentation file. The pixel values are set using the flag "-val". '
+                                                 'Several pairs can be processed at once with "-dir" or "-manifest".')
+    parser.add_argument('-i', type=str, help='Input binary mask. Example: sub-001_T2w_label-sacrum_seg.nii.gz')
+    parser.add_argument('-seg', type=str, help='Existing segmentation where the mask will be added. Example: sub-001_T2w_label-totalseg_dseg.nii.gz')
+    parser.add_argument('-o', type=str, help='Output path where the final segmentation will be stored. Example: sub-001_T2w_label-totalseg_dseg.nii.gz. '
+                                             'With "-dir" or "-manifest": output folder.')
     parser.add_argument('-val', type=int, help='Pixel values (integer) which will be used for the masked region.', required=True)
+    parser.add_argument('-dir', type=str, help='Folder containing pairs of masks and segmentations, matched with "-mask-suffix" and "-seg-suffix".')
+    parser.add_argument('-manifest', type=str, help='CSV file with the columns "mask", "seg" and optionally "out", one pair per row.')
+    parser.add_argument('-mask-suffix', type=str, default='_SC.nii.gz', help='Suffix of the masks in "-dir". Default: _SC.nii.gz')
+    parser.add_argument('-seg-suffix', type=str, default='_GM.nii.gz', help='Suffix of the segmentations in "-dir". Default: _GM.nii.gz')
+    parser.add_argument('-jobs', type=int, default=1, help='Number of processes used with "-dir" or "-manifest". Default: 1')
     return parser
 
 
@@ -18,51 +28,183 @@ def main():
     parser = get_parser()
     args = parser.parse_args()
 
-    fname_mask = args.i
-    fname_seg = args.seg
-    fname_file_out = args.o
-    val = args.val
+    if args.dir is not None or args.manifest is not None:
+        if args.o is None and args.manifest is None:
+            parser.error('-o is required with -dir')
+        if args.dir is not None:
+            pairs = find_pairs(args.dir, args.o, args.mask_suffix, args.seg_suffix)
+        else:
+            pairs = read_manifest(args.manifest, args.o)
+        status = batch_add_mask_to_seg(pairs, args.val, jobs=args.jobs)
+        print_status_table(status)
+    else:
+        if args.i is None or args.seg is None or args.o is None:
+            parser.error('-i, -seg and -o are required when -dir and -manifest are not used')
+        add_mask_to_seg_file(args.i, args.seg, args.o, args.val)
 
-    # Check if output directory exists
-    if not os.path.exists(os.path.dirname(fname_file_out)):
-        os.makedirs(os.path.dirname(fname_file_out))
 
-    # Check if paths exist
-    if not os.path.exists(fname_mask):
-        raise ValueError(f'Missing input mask {fname_mask}')
-    
-    if not os.path.exists(fname_seg):
-        raise ValueError(f'Missing output segmentation {fname_seg}')
-    
-    # Open images
-    mask = Image(fname_mask)
-    seg = Image(fname_seg)
+def add_mask_to_seg(mask, seg, val):
+    """
+    Add a binary mask to a segmentation (in-place): the voxels of the mask which are zero in the segmentation are set to `val`.
 
+    :param mask: binary mask (Image)
+    :param seg: segmentation (Image), modified in-place
+    :param val: value of the masked region
+    :return: seg
+    """
     # Check image size
-    if mask.data.shape != seg.data.shape:
+    if mask.shape != seg.shape:
         raise ValueError(f'Input mask and output segmentation should have the same shape !')
 
     # Check orientation
     if mask.orientation != seg.orientation:
         print(f'Changing mask orientation to {seg.orientation}')
         mask.change_orientation(seg.orientation)
-    
-    # Check if mask is binary
-    if not np.sort(np.unique(mask.data)).tolist() == [0,1]:
+
+    # Check if mask is binary (only 0 and 1, both present), without sorting the volume with np.unique
+    mask_bool = mask.data == 1
+    nb_ones = np.count_nonzero(mask_bool)
+    nb_nonzero = np.count_nonzero(mask.data)
+    if nb_ones != nb_nonzero or nb_ones == 0 or nb_nonzero == mask.data.size:
         raise ValueError('Mask should be binary')
-    
+
     # Check if value not already in seg
-    if val in np.unique(seg.data).astype(int):
+    if (seg.data == val).any():
         raise ValueError(f'The value {val} is already present in the segmentation')
-    
-    # Add mask with value to segmentation
-    zeros_seg = (seg.data == 0).astype(int) # Only zeros will be replaced, not already existing values
-    added_mask = zeros_seg*mask.data
-    seg.data[added_mask.astype(bool)] = val # Add new value
+
+    # Add mask with value to segmentation, in the dtype of the segmentation
+    mask_bool &= seg.data == 0 # Only zeros will be replaced, not already existing values
+    np.putmask(seg.data, mask_bool, val) # Add new value
+    return seg
+
+
+def add_mask_to_seg_file(fname_mask, fname_seg, fname_file_out, val):
+    """
+    Load a mask and a segmentation, add the mask to the segmentation with `add_mask_to_seg` and save the result.
+    """
+    # Check if output directory exists (exist_ok: several processes may create it at the same time)
+    if os.path.dirname(fname_file_out):
+        os.makedirs(os.path.dirname(fname_file_out), exist_ok=True)
+
+    # Check if paths exist
+    if not os.path.exists(fname_mask):
+        raise ValueError(f'Missing input mask {fname_mask}')
+
+    if not os.path.exists(fname_seg):
+        raise ValueError(f'Missing output segmentation {fname_seg}')
+
+    # Open images (the voxels are only decoded after the shape check)
+    mask = Image(fname_mask, lazy=True)
+    seg = Image(fname_seg, lazy=True)
+
+    # Add mask to segmentation
+    add_mask_to_seg(mask, seg, val)
 
     # Save new seg
     seg.save(fname_file_out)
 
 
+def fuse_labels(path_label_SC, path_label_GM, path_out):
+    """
+    Fuse the SC and GM labels of a subject into a single region-based label (SC=1, GM=2).
+
+    Each label is loaded once in its on-disk datatype, and the fused label is written in a single pass as uint8.
+
+    :param path_label_SC: path to the spinal cord label
+    :param path_label_GM: path to the grey matter label
+    :param path_out: path to the fused label
+    """
+    label_SC = nib.load(path_label_SC)
+    label_GM = nib.load(path_label_GM)
+    data_SC = np.asanyarray(label_SC.dataobj)
+    data_GM = np.asanyarray(label_GM.dataobj)
+    if data_SC.shape != data_GM.shape:
+        raise ValueError(f'{path_label_SC} and {path_label_GM} should have the same shape')
+
+    # GM voxels are set to 2, the other SC voxels to 1
+    data_fused = np.where(data_GM > 0, np.uint8(2), (data_SC > 0).astype(np.uint8))
+
+    label_fused = nib.Nifti1Image(data_fused, label_SC.affine, label_SC.header)
+    label_fused.set_data_dtype(np.uint8)
+    nib.save(label_fused, path_out)
+
+
+def find_pairs(folder, folder_out, mask_suffix='_SC.nii.gz', seg_suffix='_GM.nii.gz'):
+    """
+    Find the (mask, segmentation, output) triplets of a folder: each file ending with `mask_suffix` is paired with the
+    file ending with `seg_suffix` with the same prefix. The output has the name of the segmentation, in `folder_out`.
+    Masks without a segmentation are paired with None.
+    """
+    pairs = []
+    for fname in sorted(os.listdir(folder)):
+        if fname.endswith(mask_suffix):
+            fname_seg = fname[:-len(mask_suffix)] + seg_suffix
+            path_seg = os.path.join(folder, fname_seg)
+            pairs.append((os.path.join(folder, fname),
+                          path_seg if os.path.exists(path_seg) else None,
+                          os.path.join(folder_out, fname_seg)))
+    return pairs
+
+
+def read_manifest(path_manifest, folder_out=None):
+    """
+    Read the (mask, segmentation, output) triplets of a CSV file with the columns "mask", "seg" and optionally "out".
+    When "out" is missing, the output has the name of the segmentation, in `folder_out`.
+    """
+    pairs = []
+    with open(path_manifest, newline='') as f:
+        for row in csv.DictReader(f):
+            fname_out = row.get('out') or os.path.join(folder_out, os.path.basename(row['seg']))
+            pairs.append((row['mask'], row['seg'], fname_out))
+    return pairs
+
+
+def _process_pair(pair, function, args):
+    fname_mask, fname_seg, fname_file_out = pair
+    if fname_seg is None:
+        return 'SKIPPED', 'No matching segmentation'
+    try:
+        function(fname_mask, fname_seg, fname_file_out, *args)
+        return 'OK', ''
+    except Exception as e:
+        return 'FAILED', f'{type(e).__name__}: {e}'
+
+
+def batch_process_pairs(pairs, function, args=(), jobs=1):
+    """
+    Call `function(mask, segmentation, output, *args)` on a list of (mask, segmentation, output) triplets, in a pool
+    of `jobs` processes if `jobs` > 1. The failure of a pair does not stop the others.
+
+    :return: list of (mask, segmentation, output, status, message), in the same order as `pairs`
+    """
+    # Create the output folders before dispatching the pairs to the processes
+    for folder in {os.path.dirname(pair[2]) for pair in pairs} - {''}:
+        os.makedirs(folder, exist_ok=True)
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(_process_pair, pairs, [function] * len(pairs), [args] * len(pairs)))
+    else:
+        results = [_process_pair(pair, function, args) for pair in pairs]
+    return [(*pair, status, message) for pair, (status, message) in zip(pairs, results)]
+
+
+def batch_add_mask_to_seg(pairs, val, jobs=1):
+    """
+    Add the masks to the segmentations of a list of (mask, segmentation, output) triplets (see `batch_process_pairs`).
+    """
+    return batch_process_pairs(pairs, add_mask_to_seg_file, (val,), jobs=jobs)
+
+
+def print_status_table(status):
+    """
+    Print the status table returned by `batch_process_pairs`.
+    """
+    print(f'{"STATUS":<8} {"MASK":<50} MESSAGE')
+    for fname_mask, _, _, pair_status, message in status:
+        print(f'{pair_status:<8} {os.path.basename(fname_mask):<50} {message}')
+    nb_ok = sum(pair_status == 'OK' for *_, pair_status, _ in status)
+    print(f'{nb_ok}/{len(status)} pairs processed successfully')
+
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
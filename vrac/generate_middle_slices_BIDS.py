@@ -1,30 +1,173 @@
-from BIDSIFICATION.image import Image
+"""
+Save a PNG preview of the middle sagittal slice (RSP orientation) of all the images of a BIDS dataset.
+
+The on-disk axis and index of the middle sagittal slice are found from the affine alone, and only this slice is read
+through nibabel's `dataobj` slicing: the volume is never fully loaded nor reoriented.
+For images with more than 3 dimensions, the first volume is used. The slice is normalised to uint8 before being saved.
+
+The previews are regenerated incrementally: a manifest (preview_manifest.json in the output folder) records the size
+and modification time of each source image with its PNG, so that only new or modified images are rendered, and the
+PNGs of the images which were removed from the dataset are deleted.
+
+Example:
+    python generate_middle_slices_BIDS.py --path-bids /Users/nathan/data/whole-spine --jobs 8
+"""
+
+from BIDSIFICATION.image import orientation_string_nib2sct, get_permutations
 import os
-import glob
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import cv2
 import numpy as np
+import nibabel as nib
 from progress.bar import Bar
 
-path_to_BIDS = '/Users/nathan/data/whole-spine'
-output_folder_path = os.path.join(path_to_BIDS, 'derivatives/preview')
 
-# Fetch all the niftii files in the BIDS folder
-glob_files = glob.glob(os.path.join(path_to_BIDS,'**', '*.nii.gz'), recursive=True)
+MANIFEST_FILENAME = 'preview_manifest.json'
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Save a PNG preview of the middle sagittal slice of all the images of a BIDS dataset.')
+    parser.add_argument('--path-bids', type=str, required=True, help='Path to the BIDS dataset')
+    parser.add_argument('--output-folder', type=str, help='Output folder. Default: <path-bids>/derivatives/preview')
+    parser.add_argument('--overwrite', action='store_true', help='Regenerate all the previews, ignoring the manifest')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='Number of processes. Default: 1')
+    return parser
+
+
+def get_middle_slice(file_path, orientation='RSP'):
+    """
+    Read the middle slice along the first axis of `orientation`, as it would be obtained with
+    `Image(file_path).change_orientation(orientation).data[shape[0]//2]`, without loading the whole volume.
+
+    :return: 2D array, with the 2 other axes of `orientation`
+    """
+    img = nib.load(file_path)
+    img_orientation = orientation_string_nib2sct(''.join(nib.orientations.aff2axcodes(img.header.get_best_affine())))
+    perm, inversion = get_permutations(img_orientation, orientation)
+
+    # On-disk axis and index of the middle slice
+    axis = perm.index(0)
+    ind = img.shape[axis] // 2
+    if inversion[axis] == -1:
+        ind = img.shape[axis] - 1 - ind
+    slicer = [slice(None)] * 3 + [0] * (len(img.shape) - 3)
+    slicer[axis] = ind
+    arr = np.asanyarray(img.dataobj[tuple(slicer)])
+
+    # Reorder and flip the 2 remaining axes as in `orientation`
+    other_axes = [i for i in range(3) if i != axis]
+    arr = arr.transpose(np.argsort([perm[i] for i in other_axes]))
+    for i, src_axis in enumerate(sorted(other_axes, key=lambda i: perm[i])):
+        if inversion[src_axis] == -1:
+            arr = np.flip(arr, i)
+    return arr
+
+
+def normalize_to_uint8(arr):
+    """
+    Rescale the intensities between 0 and 255 (min-max), as expected by cv2.imwrite.
+    """
+    arr = arr.astype(np.float32)
+    min_value, max_value = arr.min(), arr.max()
+    if max_value <= min_value:
+        return np.zeros(arr.shape, dtype=np.uint8)
+    return np.round((arr - min_value) * (255 / (max_value - min_value))).astype(np.uint8)
+
+
+def save_preview(file_path, png_path):
+    cv2.imwrite(png_path, normalize_to_uint8(get_middle_slice(file_path, 'RSP')))
+
+
+def list_images(path_to_BIDS):
+    """
+    :return: sorted list of the .nii.gz images of the BIDS dataset, without the derivatives (which are not walked)
+    """
+    nii_files = []
+    for root, dirs, files in os.walk(path_to_BIDS):
+        dirs[:] = [d for d in dirs if 'derivatives' not in d]
+        nii_files += [os.path.join(root, f) for f in files if f.endswith('.nii.gz')]
+    return sorted(nii_files)
+
+
+def get_file_signature(file_path):
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def load_manifest(manifest_path):
+    """
+    :return: dict {source image path (relative to the BIDS folder): {'size', 'mtime', 'png'}}
+    """
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, manifest_path):
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    path_to_BIDS = args.path_bids
+    output_folder_path = args.output_folder or os.path.join(path_to_BIDS, 'derivatives/preview')
+    manifest_path = os.path.join(output_folder_path, MANIFEST_FILENAME)
+
+    # Fetch all the niftii files in the BIDS folder, except the derivatives to only have images
+    nii_files = list_images(path_to_BIDS)
+
+    # Create output folder if it does not exists
+    if not os.path.exists(output_folder_path):
+        os.makedirs(output_folder_path)
+
+    previous_manifest = {} if args.overwrite else load_manifest(manifest_path)
+    manifest = {}
+    to_render = []
+    for file_path in nii_files:
+        rel_path = os.path.relpath(file_path, path_to_BIDS)
+        file_name = os.path.basename(file_path).split('.')[0] + '.png'
+        entry = {**get_file_signature(file_path), 'png': file_name}
+        if previous_manifest.get(rel_path) == entry and os.path.exists(os.path.join(output_folder_path, file_name)):
+            manifest[rel_path] = entry
+        else:
+            to_render.append((rel_path, file_path, entry))
+
+    # Remove the previews of the images which are not in the dataset anymore
+    current_pngs = {entry['png'] for _, _, entry in to_render} | {entry['png'] for entry in manifest.values()}
+    for rel_path, entry in previous_manifest.items():
+        png_path = os.path.join(output_folder_path, entry['png'])
+        if rel_path not in manifest and entry['png'] not in current_pngs and os.path.exists(png_path):
+            os.remove(png_path)
+    print(f'{len(to_render)} previews to generate, {len(manifest)} up to date')
 
-# Remove files from derivatives to only have images
-nii_files = [file for file in glob_files if 'derivatives' not in file]
+    # Init progression bar
+    bar = Bar('Convert data ', max=len(to_render))
 
-# Create output folder if it does not exists
-if not os.path.exists(output_folder_path):
-    os.makedirs(output_folder_path)
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(save_preview, file_path, os.path.join(output_folder_path, entry['png'])): (rel_path, entry)
+                   for rel_path, file_path, entry in to_render}
+        for i, future in enumerate(as_completed(futures)):
+            rel_path, entry = futures[future]
+            try:
+                future.result()
+                manifest[rel_path] = entry
+            except Exception as e:
+                # not recorded in the manifest, so it is retried on the next run
+                print(f'\nError while generating the preview of {rel_path}: {e}')
+            bar.suffix = f'{i+1}/{len(to_render)}'
+            bar.next()
+    bar.finish()
 
-# Init progression bar
-bar = Bar('Convert data ', max=len(nii_files))
+    save_manifest(manifest, manifest_path)
 
-for file_path in nii_files:
-    img = Image(file_path).change_orientation('RSP')
-    arr = np.array(img.data)
-    ind = arr.shape[0]//2
 
-    file_name = os.path.basename(file_path).split('.')[0] + '.png'
-    cv2.imwrite(os.path.join(output_folder_path, file_name), arr[ind, :, :])
\ No newline at end of file
+if __name__ == '__main__':
+    main()
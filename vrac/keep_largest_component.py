@@ -2,13 +2,18 @@
 Based on https://github.com/neuropoly/totalsegmentator-mri 
 """
 
-import os, argparse, textwrap
-from scipy.ndimage import label
+import os, argparse, textwrap, csv
+from concurrent.futures import ProcessPoolExecutor
+from scipy.ndimage import label, find_objects
 from pathlib import Path
 import numpy as np
 import nibabel as nib
 
 
+SUMMARY_FILENAME = 'keep_largest_component_summary.csv'
+SUMMARY_COLUMNS = ['seg_in', 'label', 'kept_voxels', 'removed_components', 'removed_voxels', 'removed_volume_mm3']
+
+
 def get_parser():
     # parse command line arguments
     parser = argparse.ArgumentParser(
@@ -18,13 +23,40 @@ def get_parser():
         formatter_class=argparse.RawTextHelpFormatter
     )
     parser.add_argument(
-        '--seg-in', type=str, required=True,
+        '--seg-in', type=str,
         help='Input segmentation path'
     )
     parser.add_argument(
-        '--seg-out', type=str, required=True, 
+        '--seg-out', type=str,
         help='Output segmentation path'
     )
+    parser.add_argument(
+        '--dir-in', type=str,
+        help='Input folder: all the .nii.gz segmentations of the folder are processed (instead of --seg-in)'
+    )
+    parser.add_argument(
+        '--dir-out', type=str,
+        help='Output folder, used with --dir-in. The outputs have the same names as the inputs'
+    )
+    parser.add_argument(
+        '--manifest', type=str,
+        help='CSV file with the columns "seg_in" and "seg_out", one segmentation per row (instead of --seg-in)'
+    )
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=1,
+        help='Number of processes used with --dir-in or --manifest (default: 1)'
+    )
+    parser.add_argument(
+        '--summary', type=str,
+        help=textwrap.dedent(f'''
+            CSV file where the volumes of the removed components of each label are written, used with --dir-in or
+            --manifest (default: {SUMMARY_FILENAME} in --dir-out, or next to the manifest)
+        '''),
+    )
+    parser.add_argument(
+        '--overwrite', action='store_true',
+        help='Process all the segmentations, even when the output is more recent than the input'
+    )
     parser.add_argument(
         '--verbose', '-v', type=int, default=1, choices=[0, 1],
         help='Verbosity level. 0: Errors/warnings only, 1: Errors/warnings + info (default: 1)'
@@ -43,6 +75,21 @@ def main():
     seg_out = args.seg_out
     verbose = args.verbose
 
+    if args.dir_in is not None or args.manifest is not None:
+        if args.dir_in is not None:
+            if args.dir_out is None:
+                parser.error('--dir-out is required with --dir-in')
+            pairs = list_dir_pairs(args.dir_in, args.dir_out)
+            summary_path = args.summary or os.path.join(args.dir_out, SUMMARY_FILENAME)
+        else:
+            pairs = read_manifest(args.manifest)
+            summary_path = args.summary or os.path.join(os.path.dirname(os.path.abspath(args.manifest)), SUMMARY_FILENAME)
+        keep_largest_component_batch(pairs, summary_path, jobs=args.jobs, overwrite=args.overwrite, verbose=verbose)
+        return
+
+    if seg_in is None or seg_out is None:
+        parser.error('--seg-in and --seg-out are required when --dir-in and --manifest are not used')
+
     if verbose:
         print(textwrap.dedent(f'''
             Running {Path(__file__).stem} with the following params:
@@ -69,25 +116,131 @@ def keep_largest_component(
 
     seg_data = np.zeros_like(seg_data_src)
 
-    for l in [_ for _ in np.unique(seg_data_src) if _ != 0]:
-        mask = seg_data_src == l
+    # Volumes of the removed components, for QC
+    voxel_volume = float(np.prod(seg.header.get_zooms()[:3]))
+    stats = []
+
+    # Bounding box of each label (index l - 1), None for the labels which are absent.
+    # All the components of a label lie inside its bounding box, so labeling the box gives the same components
+    # (in the same order) as labeling the full volume.
+    for l, bbox in enumerate(find_objects(seg_data_src), start=1):
+        if bbox is None:
+            continue
+        mask = seg_data_src[bbox] == l
         mask_labeled, num_labels = label(mask, np.ones((3, 3, 3)))
         # Find the label of the largest component
         label_sizes = np.bincount(mask_labeled.ravel())[1:]  # Skip 0 label size
         largest_label = label_sizes.argmax() + 1  # +1 because bincount labels start at 0
-        seg_data[mask_labeled == largest_label] = l
+        seg_data[bbox][mask_labeled == largest_label] = l
+        removed_voxels = int(label_sizes.sum() - label_sizes[largest_label - 1])
+        stats.append({'label': l,
+                      'kept_voxels': int(label_sizes[largest_label - 1]),
+                      'removed_components': num_labels - 1,
+                      'removed_voxels': removed_voxels,
+                      'removed_volume_mm3': removed_voxels * voxel_volume})
 
     # Create result segmentation
     seg = nib.Nifti1Image(seg_data, seg.affine, seg.header)
     seg.set_data_dtype(np.uint8)
 
-    # Make sure output directory exists
-    if not os.path.exists(os.path.dirname(seg_out)):
-        os.makedirs(os.path.dirname(seg_out))
+    # Make sure output directory exists (exist_ok: several processes may create it at the same time)
+    if os.path.dirname(seg_out):
+        os.makedirs(os.path.dirname(seg_out), exist_ok=True)
 
     # Save mapped segmentation
     nib.save(seg, seg_out)
 
+    return stats
+
+
+def list_dir_pairs(dir_in, dir_out):
+    """
+    :return: list of (seg_in, seg_out) for all the .nii.gz files of dir_in
+    """
+    return [(os.path.join(dir_in, f), os.path.join(dir_out, f)) for f in sorted(os.listdir(dir_in)) if f.endswith('.nii.gz')]
+
+
+def read_manifest(manifest):
+    """
+    :return: list of (seg_in, seg_out) read from a CSV file with the columns "seg_in" and "seg_out"
+    """
+    with open(manifest, newline='') as f:
+        return [(row['seg_in'], row['seg_out']) for row in csv.DictReader(f)]
+
+
+def is_up_to_date(seg_in, seg_out):
+    """
+    The output is up to date when it is more recent than the input.
+    """
+    return os.path.exists(seg_out) and os.path.getmtime(seg_out) >= os.path.getmtime(seg_in)
+
+
+def _process_pair(pair):
+    seg_in, seg_out = pair
+    try:
+        return keep_largest_component(seg_in, seg_out), None
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+
+
+def read_summary(summary_path):
+    """
+    :return: dict {seg_in: list of the summary rows of seg_in} read from an existing summary, empty if there is none
+    """
+    rows = {}
+    if os.path.exists(summary_path):
+        with open(summary_path, newline='') as f:
+            for row in csv.DictReader(f):
+                rows.setdefault(row['seg_in'], []).append(row)
+    return rows
+
+
+def keep_largest_component_batch(pairs, summary_path, jobs=1, overwrite=False, verbose=1):
+    """
+    Run keep_largest_component on a list of (seg_in, seg_out), in a pool of `jobs` processes if `jobs` > 1.
+    The segmentations whose output is up to date are skipped (unless `overwrite`), and their rows of the previous
+    summary are kept. The volumes of the removed components of each label are written to `summary_path`.
+    """
+    previous_summary = read_summary(summary_path)
+    to_process = [pair for pair in pairs if overwrite or not is_up_to_date(*pair)]
+    if verbose:
+        print(f'{len(to_process)} segmentations to process, {len(pairs) - len(to_process)} already up to date')
+
+    # Create the output directories before dispatching the segmentations to the processes
+    for folder in {os.path.dirname(seg_out) for _, seg_out in to_process} - {''}:
+        os.makedirs(folder, exist_ok=True)
+
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = dict(zip(to_process, executor.map(_process_pair, to_process)))
+    else:
+        results = {pair: _process_pair(pair) for pair in to_process}
+
+    summary = []
+    for pair in pairs:
+        seg_in = pair[0]
+        if pair not in results:
+            summary += previous_summary.get(seg_in, [])
+            continue
+        stats, error = results[pair]
+        if error is not None:
+            print(f'Error while processing {seg_in}: {error}')
+            continue
+        summary += [{'seg_in': seg_in, **label_stats} for label_stats in stats]
+        if verbose:
+            print(f'{seg_in}: {sum(label_stats["removed_components"] for label_stats in stats)} components removed')
+
+    # Make sure output directory exists
+    if os.path.dirname(summary_path):
+        os.makedirs(os.path.dirname(summary_path), exist_ok=True)
+
+    with open(summary_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_COLUMNS)
+        writer.writeheader()
+        writer.writerows(summary)
+    if verbose:
+        print(f'Summary of the removed components saved to {summary_path}')
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
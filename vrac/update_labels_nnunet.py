@@ -1,57 +1,177 @@
+"""
+Create a new nnUNet dataset by remapping the labels of an existing one.
+
+The mapping {old value: new value} is given with a JSON file (--mapping) and/or on the command line (--map), and is
+applied to each label file with a single lookup table (LUT) gather. Several old values can be merged into the same
+new value, and the values which are not mapped are set to 0.
+
+Only the labels are decoded and rewritten: the images are passed through byte-for-byte (hardlink, reflink, symlink or
+copy, see --img-mode).
+
+Example (all the discs of Dataset100_TotalSegMRI merged into a single class):
+    python update_labels_nnunet.py --path-in nnUNet_raw/Dataset100_TotalSegMRI --path-out nnUNet_raw/Dataset102_discs-1class --map 25-47:1 --jobs 8
+"""
+
 from BIDSIFICATION.image import Image
 import os
+import json
+import shutil
+import fcntl
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 from progress.bar import Bar
 
-path_nnunet_folder = '/home/GRAMES.POLYMTL.CA/p118739/data_nvme_p118739/data/nnunet_data/nnUNet_raw/Dataset100_TotalSegMRI'
-path_new_folder = '/home/GRAMES.POLYMTL.CA/p118739/data_nvme_p118739/data/nnunet_data/nnUNet_raw/Dataset102_discs-1class'
-one_class = True
 
-label_folder = 'labelsTr'
-img_folder = 'imagesTr'
-ext = '.nii.gz'
-discs_indx = np.arange(25, 48)
+def get_parser():
+    parser = argparse.ArgumentParser(description='Create a new nnUNet dataset by remapping the labels of an existing one.')
+    parser.add_argument('--path-in', type=str, required=True, help='Path to the input nnUNet dataset')
+    parser.add_argument('--path-out', type=str, required=True, help='Path to the new nnUNet dataset')
+    parser.add_argument('--mapping', type=str, help='JSON file with the mapping {"old value": new value}')
+    parser.add_argument('--map', type=str, nargs='+', default=[],
+                        help='Mapping given as "old:new" or "first-last:new" (e.g. 25-47:1), applied after --mapping')
+    parser.add_argument('--label-folder', type=str, default='labelsTr', help='Label folder. Default: labelsTr')
+    parser.add_argument('--img-folder', type=str, default='imagesTr', help='Image folder. Default: imagesTr')
+    parser.add_argument('--img-mode', type=str, default='hardlink', choices=['hardlink', 'reflink', 'symlink', 'copy'],
+                        help='How the images are passed to the new dataset. hardlink and reflink fall back to a copy '
+                             'when the filesystem does not support them. Default: hardlink')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='Number of processes. Default: 1')
+    return parser
+
+
+def parse_mapping(path_json=None, items=()):
+    """
+    :return: dict {old value: new value} read from a JSON file and/or from "old:new" and "first-last:new" strings
+    """
+    mapping = {}
+    if path_json is not None:
+        with open(path_json) as f:
+            mapping.update({int(old): int(new) for old, new in json.load(f).items()})
+    for item in items:
+        old, new = item.split(':')
+        first, _, last = old.partition('-')
+        for value in range(int(first), int(last or first) + 1):
+            mapping[value] = int(new)
+    return mapping
+
+
+def build_lut(mapping):
+    """
+    :return: lookup table such that lut[old value] = new value, and 0 for the values which are not mapped
+    """
+    if min(mapping, default=0) < 0:
+        raise ValueError('Only non-negative label values can be remapped')
+    lut = np.zeros(max(mapping, default=0) + 1, dtype=np.int64)
+    for old, new in mapping.items():
+        lut[old] = new
+    return lut
+
+
+def apply_lut(data, lut):
+    """
+    Remap a label array with a single gather. The output has the same dtype as `data`, widened if some new values of
+    the mapping do not fit in it (e.g. 300 for a uint8 label map).
+    """
+    dtype = data.dtype
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        if lut.min() < info.min or lut.max() > info.max:
+            dtype = np.promote_types(dtype, np.result_type(np.min_scalar_type(lut.min()), np.min_scalar_type(lut.max())))
+            print(f'The new label values do not fit in {data.dtype}, the labels are saved as {dtype}')
+    if data.size == 0:
+        return data.astype(dtype)
+
+    index = data if np.issubdtype(data.dtype, np.integer) else data.astype(np.int64)
+    max_value = index.max()
+    if index.min() < 0:
+        raise ValueError('Only non-negative label values can be remapped')
+    if max_value >= lut.size:
+        # values above the mapping are not mapped
+        lut = np.concatenate([lut, np.zeros(max_value + 1 - lut.size, dtype=lut.dtype)])
+    return lut.astype(dtype)[index]
+
 
-labels_path = [os.path.join(path_nnunet_folder, label_folder, f) for f in os.listdir(os.path.join(path_nnunet_folder,label_folder))]
+# ioctl request to clone a file (copy-on-write copy on btrfs, XFS...), see ioctl_ficlone(2)
+FICLONE = 0x40049409
 
-# Init progression bar
-bar = Bar('Convert data ', max=len(labels_path))
 
-for label_path in labels_path:
-    filename = label_path.split('/')[-1].split(ext)[0]
-    img_path = os.path.join(path_nnunet_folder, img_folder, filename + '_0000' + ext)
-    new_label_path = os.path.join(path_new_folder, label_folder, filename + ext)
-    new_img_path = os.path.join(path_new_folder, img_folder, filename + '_0000' + ext)
+def reflink(src, dst):
+    with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+        fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+
+
+def pass_through(src, dst, mode='hardlink'):
+    """
+    Pass a file byte-for-byte to dst, without decoding it.
+
+    :param mode: 'hardlink', 'reflink', 'symlink' or 'copy'. hardlink and reflink fall back to a copy when they are not
+    supported (e.g. different filesystems)
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if mode == 'symlink':
+        os.symlink(os.path.abspath(src), dst)
+        return
+    try:
+        if mode == 'hardlink':
+            os.link(src, dst)
+            return
+        if mode == 'reflink':
+            reflink(src, dst)
+            return
+    except OSError:
+        if os.path.lexists(dst):
+            os.remove(dst)
+    shutil.copyfile(src, dst)
+
+
+def update_case(label_path, img_path, new_label_path, new_img_path, lut, img_mode='hardlink'):
+    """
+    Remap the labels of a case and pass its image to the new dataset.
+    """
+    label = Image(label_path)
+    label.data = apply_lut(label.data, lut)
+    label.save(new_label_path)
+    pass_through(img_path, new_img_path, img_mode)
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    ext = '.nii.gz'
+    mapping = parse_mapping(args.mapping, args.map)
+    if not mapping:
+        parser.error('No mapping given, use --mapping and/or --map')
+    lut = build_lut(mapping)
 
     # Create output directories
-    if not os.path.exists(os.path.dirname(new_label_path)):
-        os.makedirs(os.path.dirname(new_label_path))
-
-    if  not os.path.exists(os.path.dirname(new_img_path)):
-        os.makedirs(os.path.dirname(new_img_path))
-    
-    if os.path.exists(img_path) and os.path.exists(label_path):
-        img = Image(img_path)
-        label = Image(label_path)
-        data = label.data
-        new_data = np.zeros_like(data)
-        for i, num in enumerate(discs_indx):
-            new_data[np.where(data==num)] = int(i + 1) if not one_class else 1
-        label.data = new_data
-        label.save(new_label_path)
-        img.save(new_img_path)
-    else:
-        raise ValueError(f'{img_path} or {label_path} do not exist')
-    
-    # Plot progress
-    bar.suffix  = f'{labels_path.index(label_path)+1}/{len(labels_path)}'
-    bar.next()
-bar.finish()
-        
-    
-
-
-    
-    
-    
+    for folder in [args.label_folder, args.img_folder]:
+        os.makedirs(os.path.join(args.path_out, folder), exist_ok=True)
+
+    cases = []
+    for f in sorted(os.listdir(os.path.join(args.path_in, args.label_folder))):
+        filename = f.split(ext)[0]
+        label_path = os.path.join(args.path_in, args.label_folder, f)
+        img_path = os.path.join(args.path_in, args.img_folder, filename + '_0000' + ext)
+        new_label_path = os.path.join(args.path_out, args.label_folder, filename + ext)
+        new_img_path = os.path.join(args.path_out, args.img_folder, filename + '_0000' + ext)
+        if not os.path.exists(img_path) or not os.path.exists(label_path):
+            raise ValueError(f'{img_path} or {label_path} do not exist')
+        cases.append((label_path, img_path, new_label_path, new_img_path))
+
+    # Init progression bar
+    bar = Bar('Convert data ', max=len(cases))
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(update_case, *case, lut, args.img_mode) for case in cases]
+        for i, future in enumerate(as_completed(futures)):
+            future.result()
+            # Plot progress
+            bar.suffix = f'{i+1}/{len(cases)}'
+            bar.next()
+    bar.finish()
+
 
+if __name__ == '__main__':
+    main()